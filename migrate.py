@@ -13,6 +13,18 @@ import re # Do operacji na stringach (regex)
 import pwd # Do weryfikacji właściciela (choć teraz mniej potrzebne)
 import grp # Do weryfikacji grupy (choć teraz mniej potrzebne)
 import stat # Do chmod
+import zipfile # Do weryfikacji plików względem katalogu centralnego ZIP
+import zlib # CRC32
+import concurrent.futures # Równoległa weryfikacja
+import concurrent.futures.process # BrokenProcessPool (awaria puli procesów)
+import threading # Bufory odczytu per wątek
+import mmap # Szybkie wstępne filtrowanie plików przy podmianie domeny
+import tempfile # Atomowy zapis przepisywanych plików
+import heapq # Największe opcje autoload
+import hashlib # Cache przetworzonych obrazów (hash zawartości)
+import queue # Kolejka zdarzeń dla wątku renderującego
+import socket # Strumień zdarzeń do gniazda (unix/tcp)
+import uuid # Identyfikator uruchomienia w zdarzeniach
 
 # --- Konfiguracja ---
 WP_ROOT_DIR = "/var/www/html/wp"
@@ -23,13 +35,39 @@ FULL_TEMP_DIR = os.path.join(WP_ROOT_DIR, TEMP_DIR_NAME)
 FULL_TEMP_WP_CONFIG_PATH = os.path.join(FULL_TEMP_DIR, "wp-config.php.original_target")
 FINAL_ZIP_FILE = "backup_finalny.zip"
 FULL_FINAL_ZIP_PATH = os.path.join(FULL_TEMP_DIR, FINAL_ZIP_FILE)
+JOURNAL_FILE_NAME = "migration-journal.json" # Dziennik ukończonych etapów (dla --resume)
+FULL_JOURNAL_PATH = os.path.join(FULL_TEMP_DIR, JOURNAL_FILE_NAME)
+JOURNAL_VERSION = 1
 CHUNK_SIZE = 5242880 # 5MB
+EVENT_PROGRESS_INTERVAL = 0.5 # s - minimalny odstęp między zdarzeniami postępu tego samego etapu
+EVENT_QUEUE_SIZE = 10000 # Przy pełnej kolejce zdarzenia postępu są odrzucane (inne czekają)
+EVENT_SOCKET_TIMEOUT = 10 # s - zablokowany odbiorca zdarzeń na gnieździe jest po tym czasie odłączany
 WP_CLI_BIN = "wp" # Domyślna nazwa, zostanie zweryfikowana i potencjalnie zaktualizowana w main()
 WP_CLI_FLAGS = ["--allow-root"]
 WEB_USER = "www-data" # Nadal może być potrzebne dla skryptu sh, jeśli go używa
 WEB_GROUP = "www-data" # Nadal może być potrzebne dla skryptu sh, jeśli go używa
 FIX_PERMISSIONS_SCRIPT_URL = "https://raw.githubusercontent.com/TheBlackSurf/kody/refs/heads/main/fix_wp_chmod.sh"
 FIX_PERMISSIONS_SCRIPT_NAME = "fix_wp_chmod_temp.sh" # Tymczasowa nazwa pliku
+VERIFY_READ_BUFFER = 8388608 # 8MB - bufor odczytu przy strumieniowym czytaniu zrzutu SQL
+VERIFY_CRC_BUFFER = 2097152 # 2MB - bufor odczytu przy liczeniu CRC32 (jeden na wątek)
+VERIFY_CRC_WORKERS = min(8, os.cpu_count() or 1) # Wątki CRC32 - zlib.crc32 zwalnia GIL, więcej wątków głównie zwiększa zużycie pamięci
+VERIFY_DB_BATCH_SIZE = 25 # Liczba tabel w jednym zapytaniu COUNT(*) (UNION ALL)
+VERIFY_REPORT_LIMIT = 20 # Maksymalna liczba pozycji pokazywanych w raporcie dla każdej kategorii
+REWRITE_EXTENSIONS = (".php", ".css", ".js", ".json", ".html", ".htm", ".xml", ".svg", ".txt", ".map", ".htaccess") # Pliki tekstowe, w których podmieniamy domenę
+REWRITE_MAX_FILE_SIZE = 67108864 # 64MB - większe pliki pomijamy przy podmianie domeny
+REWRITE_WORKERS = os.cpu_count() or 1 # Procesy przepisujące pliki
+REWRITE_PREFILTER_WORKERS = min(32, (os.cpu_count() or 1) * 4) # Wątki wstępnego filtra (mmap, bez własnych buforów)
+AUTOLOAD_OPTION_LIMIT = 102400 # 100KB - opcje autoload większe od tego są raportowane jako zbyt duże (i wyłączane w trybie --fix-autoload)
+OPTIONS_REPORT_TOP = 10 # Liczba największych opcji autoload w raporcie
+AUTOLOAD_ENABLED_VALUES = (b"yes", b"on", b"auto", b"auto-on") # Wartości kolumny autoload oznaczające ładowanie (WP < 6.6 i >= 6.6)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png") # Obrazy optymalizowane w uploads
+IMAGE_CACHE_DIR = "/var/cache/izolka-migrate" # Poza katalogiem WWW - cache nie może być dostępny publicznie
+IMAGE_CACHE_FILE_NAME = "image-cache.json" # Cache hashy przetworzonych obrazów (przetrwa kolejne migracje)
+FULL_IMAGE_CACHE_PATH = os.path.join(IMAGE_CACHE_DIR, IMAGE_CACHE_FILE_NAME)
+LEGACY_IMAGE_CACHE_FILE_NAME = ".izolka-image-cache.json" # Dawne położenie cache w WP_ROOT_DIR (usuwane)
+IMAGE_CPU_BUDGET = 0.5 # Ułamek rdzeni CPU przeznaczony na optymalizację obrazów
+IMAGE_TIME_BUDGET = 900 # Domyślny limit czasu (s) etapu optymalizacji obrazów
+IMAGE_WEBP_QUALITY = 80 # Jakość generowanych plików WebP
 
 # --- Funkcje pomocnicze ---
 
@@ -38,7 +76,7 @@ def run_command(command, check=True, **kwargs):
     if isinstance(command, str):
         # Proste rozdzielenie po spacjach, może wymagać poprawy dla bardziej złożonych komend
         command_list = command.split()
-        print(f"Ostrzeżenie: run_command otrzymał string, konwertuję na listę: {command_list}", file=sys.stderr)
+        emit_warning(f"run_command otrzymał string, konwertuję na listę: {command_list}")
     elif isinstance(command, list):
         command_list = command
     else:
@@ -80,7 +118,7 @@ def run_command(command, check=True, **kwargs):
 
 
             if not (is_search_replace_no_change or is_db_create_exists or is_cache_flush_not_found or is_external_script_run):
-                 print(f"Ostrzeżenie: Komenda '{' '.join(command_list)}' zwróciła kod wyjścia {result.returncode}", file=sys.stderr)
+                 emit_warning(f"Komenda '{' '.join(command_list)}' zwróciła kod wyjścia {result.returncode}")
                  if stdout_output: print(f"Stdout (Ostrzeżenie):\n{stdout_output}", file=sys.stderr)
                  if stderr_output: print(f"Stderr (Ostrzeżenie):\n{stderr_output}", file=sys.stderr)
             elif is_search_replace_no_change:
@@ -91,7 +129,7 @@ def run_command(command, check=True, **kwargs):
                 print(f"  Informacja: Nie znaleziono obiektu cache do wyczyszczenia lub mechanizm nie jest aktywny.")
             elif is_external_script_run and result.returncode != 0:
                  # Logujemy jako ostrzeżenie, jeśli skrypt zewnętrzny zwrócił błąd
-                 print(f"Ostrzeżenie: Zewnętrzny skrypt '{command_list[0]}' zwrócił kod wyjścia {result.returncode}", file=sys.stderr)
+                 emit_warning(f"Zewnętrzny skrypt '{command_list[0]}' zwrócił kod wyjścia {result.returncode}")
                  if stdout_output: print(f"Stdout (Skrypt Zewnętrzny):\n{stdout_output}", file=sys.stderr)
                  if stderr_output: print(f"Stderr (Skrypt Zewnętrzny):\n{stderr_output}", file=sys.stderr)
             elif is_external_script_run and result.returncode == 0:
@@ -124,13 +162,262 @@ def run_command(command, check=True, **kwargs):
         return None
 
 
-def print_progress(current, total, prefix='Pobieranie:'):
+def print_progress(current, total, prefix='Pobieranie:', suffix='', stream=None):
+    stream = stream or sys.stdout
     if total == 0: percent, done = 100, 50
     else:
         done = math.floor(50 * current / total)
         percent = math.floor(100 * current / total)
-    sys.stdout.write(f"\r{prefix} [{'-' * done}{' ' * (50 - done)}] {percent}%")
-    sys.stdout.flush()
+    stream.write(f"\r{prefix} [{'-' * done}{' ' * (50 - done)}] {percent}%{suffix}")
+    stream.flush()
+
+# --- Strumień zdarzeń (etapy, postęp, ostrzeżenia, logi) ---
+# Wszystkie komunikaty trafiają do jednej kolejki; osobny wątek przekazuje je do odbiorców:
+# konsoli (czytelny dla człowieka format jak dotychczas) i opcjonalnie JSON Lines do pliku lub gniazda.
+
+_event_queue = None
+_event_thread = None
+_event_run_id = uuid.uuid4().hex[:12]
+_event_seq = 0
+_event_lock = threading.Lock()
+_progress_state = {}
+_stage_started = {}
+_original_stdout = sys.stdout
+_original_stderr = sys.stderr
+
+class _EventLogWriter:
+    """Zastępuje sys.stdout/sys.stderr: każda pełna linia staje się zdarzeniem 'log' (bufor per wątek)."""
+
+    def __init__(self, stream_name, original):
+        self.stream_name = stream_name
+        self.original = original
+        self._local = threading.local()
+
+    def write(self, text):
+        buf = getattr(self._local, 'buf', '') + text
+        *lines, self._local.buf = buf.split("\n")
+        for line in lines:
+            emit_event("log", stream=self.stream_name, message=line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def flush_partial(self):
+        if getattr(self._local, 'buf', ''):
+            emit_event("log", stream=self.stream_name, message=self._local.buf)
+            self._local.buf = ''
+
+    def isatty(self):
+        return self.original.isatty()
+
+    @property
+    def encoding(self):
+        return self.original.encoding
+
+class _ConsoleSink:
+    """Dotychczasowe wyjście konsolowe: logi, ostrzeżenia i pasek postępu rysowany w miejscu."""
+
+    def __init__(self):
+        self.bar_active = False
+
+    def _end_bar(self):
+        if self.bar_active:
+            _original_stdout.write("\n")
+            self.bar_active = False
+
+    def handle(self, event):
+        event_type = event['type']
+        if event_type == "progress":
+            suffix = ""
+            if event.get('rate'):
+                rate = f"{event['rate'] / 1048576:.1f} MB/s" if event.get('unit') == "bytes" else f"{event['rate']:.1f}/s"
+                suffix = f"  {rate}" + (f", ETA {int(event['eta']) // 60}:{int(event['eta']) % 60:02d}" if event.get('eta') is not None else "")
+            print_progress(event['current'], event['total'], prefix=event.get('label') or f"{event['stage']}:", suffix=suffix, stream=_original_stdout)
+            self.bar_active = True
+            if event['current'] >= event['total']:
+                self._end_bar()
+        elif event_type == "log":
+            self._end_bar()
+            stream = _original_stderr if event['stream'] == "stderr" else _original_stdout
+            stream.write(event['message'] + "\n")
+        elif event_type == "warning":
+            self._end_bar()
+            _original_stderr.write(f"Ostrzeżenie: {event['message']}\n")
+
+    def flush(self):
+        _original_stdout.flush()
+        _original_stderr.flush()
+
+    def close(self):
+        self._end_bar()
+        self.flush()
+
+class _JsonLinesSink:
+    """Zapisuje zdarzenia jako JSON Lines do pliku, gniazda unix ('unix:/ścieżka') lub TCP ('tcp:host:port')."""
+
+    def __init__(self, target):
+        self.target = target
+        self.sock = None
+        self.file = None
+        if target.startswith("unix:"):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(EVENT_SOCKET_TIMEOUT)
+            self.sock.connect(target[len("unix:"):])
+        elif target.startswith("tcp:"):
+            host, port = target[len("tcp:"):].rsplit(":", 1)
+            self.sock = socket.create_connection((host.strip("[]"), int(port)), timeout=EVENT_SOCKET_TIMEOUT) # [::1] dla IPv6
+        else:
+            self.file = open(target, 'a', encoding='utf-8')
+        self.pending = []
+
+    def handle(self, event):
+        self.pending.append(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = "".join(self.pending)
+        self.pending = []
+        if self.sock is not None:
+            self.sock.sendall(data.encode('utf-8'))
+        else:
+            self.file.write(data)
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.sock is not None:
+            self.sock.close()
+        if self.file is not None:
+            self.file.close()
+
+_event_sinks = [_ConsoleSink()] # Bez uruchomionego strumienia zdarzenia trafiają synchronicznie na konsolę
+
+def _dispatch_events(events):
+    for sink in list(_event_sinks):
+        try:
+            for event in events:
+                sink.handle(event)
+            sink.flush()
+        except Exception as e:
+            _event_sinks.remove(sink)
+            _original_stderr.write(f"Ostrzeżenie: Odbiorca zdarzeń {type(sink).__name__} wyłączony po błędzie: {e}\n")
+
+def _event_render_loop():
+    while True:
+        events = [_event_queue.get()]
+        try:
+            while len(events) < 500:
+                events.append(_event_queue.get_nowait())
+        except queue.Empty:
+            pass
+        stop = events[-1] is None
+        _dispatch_events([event for event in events if event is not None])
+        if stop:
+            return
+
+def emit_event(event_type, **fields):
+    """Publikuje zdarzenie. Bez uruchomionego strumienia trafia ono od razu na konsolę."""
+    global _event_seq
+    with _event_lock:
+        _event_seq += 1
+        event = {'ts': round(time.time(), 3), 'seq': _event_seq, 'run_id': _event_run_id, 'type': event_type}
+    event.update(fields)
+    if _event_queue is None:
+        _dispatch_events([event])
+    elif event_type == "progress":
+        try:
+            _event_queue.put_nowait(event)
+        except queue.Full:
+            pass # Postęp można bezpiecznie pominąć - następne zdarzenie i tak go zaktualizuje
+    else:
+        _event_queue.put(event)
+
+def emit_stage(stage, status, **fields):
+    """Zdarzenie etapu: status 'start', 'skip', 'complete' lub 'error'."""
+    now = time.monotonic()
+    if status == "start":
+        _stage_started[stage] = now
+    elif stage in _stage_started:
+        fields['duration'] = round(now - _stage_started.pop(stage), 3)
+    emit_event("stage", stage=stage, status=status, **fields)
+
+def emit_progress(stage, current, total, unit="bytes", label=None):
+    """Zdarzenie postępu, ograniczone do jednego na EVENT_PROGRESS_INTERVAL sekund (plus końcowe 100%)."""
+    now = time.monotonic()
+    state = _progress_state.get(stage)
+    if state is None or current < state[2]:
+        state = _progress_state[stage] = [now, 0.0, current]
+    elif now - state[1] < EVENT_PROGRESS_INTERVAL and current < total:
+        return
+    state[1], state[2] = now, current
+    elapsed = now - state[0]
+    rate = current / elapsed if elapsed > 0 else None
+    eta = round((total - current) / rate, 1) if rate and total >= current else None
+    emit_event("progress", stage=stage, current=current, total=total, unit=unit,
+               rate=round(rate, 1) if rate else None, eta=eta, label=label)
+
+def emit_warning(message):
+    emit_event("warning", message=message)
+
+def events_target_arg(value):
+    """Typ argumentu --events: odrzuca puste ścieżki gniazd i 'tcp:' bez poprawnego portu."""
+    if value.startswith("unix:") and not value[len("unix:"):]:
+        raise argparse.ArgumentTypeError("brak ścieżki gniazda w 'unix:/ścieżka'")
+    if value.startswith("tcp:"):
+        host, _sep, port = value[len("tcp:"):].rpartition(":")
+        if not host or not port.isdigit() or not 0 < int(port) < 65536:
+            raise argparse.ArgumentTypeError(f"nieprawidłowy cel '{value}', oczekiwano 'tcp:host:port'")
+    return value
+
+def start_event_stream(events_target=None):
+    """Uruchamia wątek renderujący i przekierowuje sys.stdout/sys.stderr do strumienia zdarzeń."""
+    global _event_queue, _event_thread
+    _event_sinks[:] = [_ConsoleSink()]
+    if events_target:
+        try:
+            _event_sinks.append(_JsonLinesSink(events_target))
+        except (OSError, ValueError) as e:
+            _original_stderr.write(f"Ostrzeżenie: Nie można otworzyć celu zdarzeń '{events_target}': {e}. Zdarzenia JSON nie będą zapisywane.\n")
+    _event_queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    _event_thread = threading.Thread(target=_event_render_loop, name="event-renderer", daemon=True)
+    _event_thread.start()
+    sys.stdout = _EventLogWriter("stdout", _original_stdout)
+    sys.stderr = _EventLogWriter("stderr", _original_stderr)
+
+def stop_event_stream():
+    """Opróżnia kolejkę, zatrzymuje wątek renderujący i przywraca oryginalne sys.stdout/sys.stderr."""
+    global _event_queue, _event_thread
+    if _event_queue is None:
+        return
+    for writer in (sys.stdout, sys.stderr):
+        if isinstance(writer, _EventLogWriter):
+            writer.flush_partial()
+    sys.stdout, sys.stderr = _original_stdout, _original_stderr
+    _event_queue.put(None)
+    _event_thread.join()
+    _event_queue = None
+    _event_thread = None
+    for sink in _event_sinks:
+        try:
+            sink.close()
+        except Exception:
+            pass
+    _event_sinks[:] = [_ConsoleSink()]
+
+def detach_event_stream_in_worker():
+    """Wywoływane w inicjalizatorze procesu potomnego (fork): odłącza go od kolejki i wątku rodzica.
+
+    Nikt nie czyta kopii kolejki w potomku, a jej blokada mogła zostać skopiowana w stanie zajętym -
+    wyjście procesu roboczego trafia więc bezpośrednio na konsolę.
+    """
+    global _event_queue, _event_thread, _event_lock
+    sys.stdout, sys.stderr = _original_stdout, _original_stderr
+    _event_queue = None
+    _event_thread = None
+    _event_lock = threading.Lock()
+    _event_sinks[:] = [_ConsoleSink()]
 
 def get_file_size(filepath):
     try: return os.path.getsize(filepath)
@@ -139,13 +426,23 @@ def get_file_size(filepath):
         print(f"\nBłąd: Nie można pobrać rozmiaru pliku '{filepath}': {e}", file=sys.stderr)
         return None
 
+def replace_with_temp_file(path, tmp_path):
+    """Atomowo zastępuje path plikiem tmp_path, zachowując uprawnienia, czasy i (jeśli można) właściciela oryginału."""
+    original_stat = os.stat(path)
+    shutil.copystat(path, tmp_path)
+    try:
+        os.chown(tmp_path, original_stat.st_uid, original_stat.st_gid)
+    except PermissionError:
+        pass
+    os.replace(tmp_path, path)
+
 def cleanup_temp_dir():
     if os.path.exists(FULL_TEMP_DIR):
         try:
             shutil.rmtree(FULL_TEMP_DIR)
             print(f"Katalog tymczasowy {FULL_TEMP_DIR} usunięty.")
         except Exception as e:
-            print(f"Ostrzeżenie: Nie udało się usunąć katalogu tymczasowego '{FULL_TEMP_DIR}': {e}", file=sys.stderr)
+            emit_warning(f"Nie udało się usunąć katalogu tymczasowego '{FULL_TEMP_DIR}': {e}")
     else:
         print(f"Katalog tymczasowy {FULL_TEMP_DIR} nie istniał, nie ma czego sprzątać.")
 
@@ -193,11 +490,783 @@ def update_table_prefix_in_config(wp_config_path, new_prefix):
         return False
 
 
+# --- Weryfikacja integralności po migracji ---
+
+_SQL_INSERT_RE = re.compile(rb"^\s*(?:INSERT|REPLACE)\s+(?:IGNORE\s+)?INTO\s+[`\"]?([^`\"\s(]+)[`\"]?", re.IGNORECASE)
+_SQL_CREATE_TABLE_RE = re.compile(rb"^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[`\"]?([^`\"\s(]+)[`\"]?", re.IGNORECASE)
+_SQL_VALUES_RE = re.compile(rb"\bVALUES\b", re.IGNORECASE)
+_SQL_OUTSIDE_STRING_RE = re.compile(rb"[()'\";]")
+_SQL_IN_SINGLE_QUOTE_RE = re.compile(rb"['\\]")
+_SQL_IN_DOUBLE_QUOTE_RE = re.compile(rb'["\\]')
+_BYTE_LPAREN, _BYTE_RPAREN, _BYTE_SEMICOLON = ord("("), ord(")"), ord(";")
+_BYTE_BACKSLASH, _BYTE_SINGLE_QUOTE = ord("\\"), ord("'")
+_verify_buffers = threading.local()
+
+def scan_sql_dump(sql_path, row_callback=None, capture_tables=None, stop_event=None):
+    """Strumieniowo przechodzi przez zrzut SQL i zwraca słownik {tabela: liczba wierszy z INSERT}.
+
+    Tabele z CREATE TABLE bez żadnego INSERT są w wyniku z liczbą 0, aby weryfikacja wykryła ich brak.
+
+    Jeśli podano row_callback, jest on wywoływany z (tabela, surowy_wiersz) dla tabel z capture_tables
+    (lub wszystkich, gdy capture_tables to None). surowy_wiersz to bajty krotki z nawiasami, np. b"(1,'a')".
+    Ustawienie stop_event (threading.Event) przerywa skanowanie wyjątkiem przy następnej linii.
+    """
+    counts = {}
+    table = None
+    awaiting_values = False
+    capture = False
+    depth = 0
+    quote = None
+    row_buf = []
+    row_from = None
+    with open(sql_path, 'rb', buffering=VERIFY_READ_BUFFER) as f:
+        for line in f:
+            if stop_event is not None and stop_event.is_set():
+                raise Exception("Skanowanie zrzutu SQL zostało przerwane.")
+            pos = 0
+            if table is None:
+                match = _SQL_INSERT_RE.match(line)
+                if not match:
+                    create_match = _SQL_CREATE_TABLE_RE.match(line)
+                    if create_match:
+                        counts.setdefault(create_match.group(1).decode('utf-8', 'replace'), 0)
+                    continue
+                table = match.group(1).decode('utf-8', 'replace')
+                counts.setdefault(table, 0)
+                capture = row_callback is not None and (capture_tables is None or table in capture_tables)
+                awaiting_values = True
+                pos = match.end()
+            if awaiting_values:
+                values_match = _SQL_VALUES_RE.search(line, pos)
+                if not values_match:
+                    continue
+                awaiting_values = False
+                pos = values_match.end()
+
+            length = len(line)
+            while pos < length:
+                if quote is None:
+                    m = _SQL_OUTSIDE_STRING_RE.search(line, pos)
+                    if not m:
+                        break
+                    char = line[m.start()]
+                    pos = m.end()
+                    if char == _BYTE_LPAREN:
+                        depth += 1
+                        if depth == 1 and capture:
+                            row_from = m.start()
+                    elif char == _BYTE_RPAREN:
+                        depth -= 1
+                        if depth == 0:
+                            counts[table] += 1
+                            if capture:
+                                row_buf.append(line[row_from:pos])
+                                row_callback(table, b"".join(row_buf))
+                                row_buf = []
+                                row_from = None
+                    elif char == _BYTE_SEMICOLON:
+                        if depth == 0:
+                            table = None
+                            break
+                    else:
+                        quote = char
+                else:
+                    string_re = _SQL_IN_SINGLE_QUOTE_RE if quote == _BYTE_SINGLE_QUOTE else _SQL_IN_DOUBLE_QUOTE_RE
+                    m = string_re.search(line, pos)
+                    if not m:
+                        break
+                    if line[m.start()] == _BYTE_BACKSLASH:
+                        pos = m.end() + 1 # Pomijamy znak poprzedzony backslashem
+                    else:
+                        quote = None
+                        pos = m.end()
+
+            if row_from is not None:
+                # Wiersz kontynuowany w następnej linii (np. surowy znak nowej linii w stringu)
+                row_buf.append(line[row_from:])
+                row_from = 0
+    return counts
+
+def _file_crc32(path):
+    """Liczy CRC32 pliku, używając dużego bufora współdzielonego w obrębie wątku."""
+    buf = getattr(_verify_buffers, 'buf', None)
+    if buf is None:
+        buf = _verify_buffers.buf = bytearray(VERIFY_CRC_BUFFER)
+    view = memoryview(buf)
+    crc = 0
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            read = f.readinto(buf)
+            if not read:
+                break
+            crc = zlib.crc32(view[:read], crc)
+    return crc
+
+def _check_extracted_file(dest_dir, name, expected_size, expected_crc):
+    path = os.path.join(dest_dir, name)
+    try:
+        if os.path.getsize(path) != expected_size:
+            return 'size'
+        if _file_crc32(path) != expected_crc:
+            return 'crc'
+    except OSError:
+        return 'missing'
+    return None
+
+def verify_extracted_files(zip_path, dest_dir, excluded_top_level):
+    """Porównuje pliki w dest_dir z katalogiem centralnym archiwum ZIP (rozmiar + CRC32).
+
+    Pomija katalogi, dowiązania symboliczne oraz wpisy, których pierwszy element ścieżki jest w excluded_top_level.
+    Zwraca słownik {'checked': int, 'missing': [...], 'size': [...], 'crc': [...]}.
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        entries = []
+        for info in zf.infolist():
+            name = info.filename.lstrip('/')
+            if name.startswith('./'):
+                name = name[2:]
+            if info.is_dir() or not name or stat.S_ISLNK(info.external_attr >> 16):
+                continue
+            if name.split('/', 1)[0] in excluded_top_level:
+                continue
+            entries.append((name, info.file_size, info.CRC))
+
+    report = {'checked': len(entries), 'missing': [], 'size': [], 'crc': []}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=VERIFY_CRC_WORKERS) as executor:
+        futures = {executor.submit(_check_extracted_file, dest_dir, name, size, crc): name for name, size, crc in entries}
+        for future in concurrent.futures.as_completed(futures):
+            problem = future.result()
+            if problem:
+                report[problem].append(futures[future])
+    for key in ('missing', 'size', 'crc'):
+        report[key].sort()
+    return report
+
+def _wp_db_query_rows(sql):
+    """Wykonuje zapytanie przez 'wp db query' i zwraca listę wierszy (listy kolumn) lub None przy błędzie."""
+    result = run_command([WP_CLI_BIN, "db", "query", sql, "--skip-column-names"] + WP_CLI_FLAGS)
+    if result is None or result.returncode != 0:
+        return None
+    return [line.split('\t') for line in result.stdout.splitlines() if line.strip()]
+
+def _quote_sql_identifier(name):
+    return "`" + name.replace("`", "``") + "`"
+
+def _quote_sql_string(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "''") + "'"
+
+def get_db_table_row_counts():
+    """Zwraca słownik {tabela: dokładna liczba wierszy} dla bieżącej bazy lub None przy błędzie.
+
+    Listę tabel pobiera z information_schema, a COUNT(*) wykonuje równolegle w paczkach po VERIFY_DB_BATCH_SIZE tabel.
+    """
+    table_rows = _wp_db_query_rows("SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'")
+    if table_rows is None:
+        return None
+    tables = [row[0] for row in table_rows]
+    batches = [tables[i:i + VERIFY_DB_BATCH_SIZE] for i in range(0, len(tables), VERIFY_DB_BATCH_SIZE)]
+    queries = [
+        " UNION ALL ".join(f"SELECT {_quote_sql_string(t)}, COUNT(*) FROM {_quote_sql_identifier(t)}" for t in batch)
+        for batch in batches
+    ]
+
+    counts = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(queries) or 1)) as executor:
+        for rows in executor.map(_wp_db_query_rows, queries):
+            if rows is None:
+                return None
+            for row in rows:
+                counts[row[0]] = int(row[1])
+    return counts
+
+def print_verification_report(file_report, dump_counts, db_counts):
+    """Wypisuje zwięzły raport różnic. Zwraca True, jeśli nie wykryto rozbieżności."""
+    ok = True
+    print("\nRaport weryfikacji:")
+    if file_report is not None:
+        problems = [('brak', file_report['missing']), ('rozmiar', file_report['size']), ('CRC32', file_report['crc'])]
+        print(f"  Pliki: sprawdzono {file_report['checked']}, brakujące: {len(file_report['missing'])}, "
+              f"zły rozmiar: {len(file_report['size'])}, zła suma CRC32: {len(file_report['crc'])}")
+        for label, names in problems:
+            for name in names[:VERIFY_REPORT_LIMIT]:
+                print(f"    - [{label}] {name}", file=sys.stderr)
+            if len(names) > VERIFY_REPORT_LIMIT:
+                print(f"    ... oraz {len(names) - VERIFY_REPORT_LIMIT} więcej ({label})", file=sys.stderr)
+            if names:
+                ok = False
+    else:
+        print("  Pliki: weryfikacja nie została wykonana.", file=sys.stderr)
+        ok = False
+
+    if dump_counts is not None and db_counts is not None:
+        missing_tables = sorted(t for t in dump_counts if t not in db_counts)
+        row_diffs = sorted((t, n, db_counts[t]) for t, n in dump_counts.items() if t in db_counts and db_counts[t] != n)
+        extra_tables = [t for t in db_counts if t not in dump_counts]
+        print(f"  Baza danych: tabel w zrzucie: {len(dump_counts)}, brakujące tabele: {len(missing_tables)}, "
+              f"różnice w liczbie wierszy: {len(row_diffs)}, tabele spoza zrzutu: {len(extra_tables)}")
+        for table in missing_tables[:VERIFY_REPORT_LIMIT]:
+            print(f"    - [brak tabeli] {table} (zrzut: {dump_counts[table]} wierszy)", file=sys.stderr)
+        for table, expected, actual in row_diffs[:VERIFY_REPORT_LIMIT]:
+            print(f"    - [wiersze] {table}: zrzut {expected}, baza {actual}", file=sys.stderr)
+        if missing_tables or row_diffs:
+            ok = False
+    else:
+        print("  Baza danych: nie udało się porównać liczby wierszy (błąd odczytu zrzutu lub zapytania do bazy).", file=sys.stderr)
+        ok = False
+
+    print("  Wynik: " + ("OK - brak rozbieżności." if ok else "WYKRYTO ROZBIEŻNOŚCI (szczegóły powyżej)."))
+    return ok
+
+def verify_migration(zip_path, dest_dir, excluded_top_level, sql_path, dump_counts=None):
+    """Równolegle weryfikuje pliki (względem ZIP) i bazę (względem zrzutu SQL), po czym drukuje raport.
+
+    Jeśli podano dump_counts (np. z analizy opcji wykonanej podczas importu), zrzut nie jest skanowany ponownie.
+    """
+    start_time = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        files_future = executor.submit(verify_extracted_files, zip_path, dest_dir, excluded_top_level)
+        dump_future = executor.submit(scan_sql_dump, sql_path) if dump_counts is None else None
+        db_future = executor.submit(get_db_table_row_counts)
+
+        results = {'dump': dump_counts}
+        for key, future in (('files', files_future), ('dump', dump_future), ('db', db_future)):
+            if future is None:
+                continue
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                emit_warning(f"Etap weryfikacji '{key}' zakończył się błędem: {e}")
+                results[key] = None
+
+    ok = print_verification_report(results['files'], results['dump'], results['db'])
+    print(f"  Czas weryfikacji: {time.monotonic() - start_time:.1f} s")
+    return ok
+
+
+# --- Podmiana domeny w plikach (motywy, wtyczki, cache CSS/JS, .htaccess) ---
+
+_rewrite_pattern = None
+_rewrite_map = None
+
+def build_url_replacements(old_urls, new_url):
+    """Zwraca listę par (stary, nowy) w bajtach, łącznie z wariantami z escapowanymi ukośnikami (JSON/JS)."""
+    pairs = {}
+    for old_url in old_urls:
+        pairs[old_url] = new_url
+        pairs[old_url.replace("/", "\\/")] = new_url.replace("/", "\\/")
+    return [(old.encode('utf-8'), new.encode('utf-8')) for old, new in pairs.items()]
+
+def find_rewrite_candidates(root_dirs, extra_files=()):
+    """Zwraca listę ścieżek plików tekstowych (wg REWRITE_EXTENSIONS) do sprawdzenia pod kątem starej domeny."""
+    candidates = [path for path in extra_files if os.path.isfile(path) and not os.path.islink(path)]
+    for root_dir in root_dirs:
+        for dirpath, _dirnames, filenames in os.walk(root_dir):
+            for filename in filenames:
+                if not filename.lower().endswith(REWRITE_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, filename)
+                if not os.path.islink(path):
+                    candidates.append(path)
+    return candidates
+
+def _file_contains_any(path, needles):
+    """Tani filtr wstępny: mmap + find dla każdego wariantu URL, bez wczytywania pliku do pamięci."""
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0 or size > REWRITE_MAX_FILE_SIZE:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return any(mm.find(needle) != -1 for needle in needles)
+    except (OSError, ValueError):
+        return False
+
+def _init_rewrite_worker(replacements):
+    global _rewrite_pattern, _rewrite_map
+    detach_event_stream_in_worker()
+    _rewrite_map = dict(replacements)
+    # Najdłuższe warianty najpierw, jedno przejście - nowy URL nigdy nie jest ponownie podmieniany.
+    # Granica hosta: nie ruszamy domen, które tylko zaczynają się od starej (np. old.community, old.com-partner.pl)
+    variants = b"|".join(re.escape(old) for old in sorted(_rewrite_map, key=len, reverse=True))
+    _rewrite_pattern = re.compile(b"(?:" + variants + rb")(?![A-Za-z0-9-]|\.[A-Za-z0-9])")
+
+def _rewrite_file(path):
+    """Podmienia URL-e w pliku i zapisuje go atomowo (plik tymczasowy + os.replace). Zwraca (ścieżka, liczba zamian, błąd)."""
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        new_content, replaced = _rewrite_pattern.subn(lambda m: _rewrite_map[m.group(0)], content)
+        if not replaced:
+            return path, 0, None
+        fd, tmp_path = tempfile.mkstemp(prefix=".izolka-rewrite-", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(new_content)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            replace_with_temp_file(path, tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path, replaced, None
+    except Exception as e:
+        return path, 0, str(e)
+
+def rewrite_domain_in_files(root_dirs, extra_files, old_urls, new_url):
+    """Podmienia stare URL-e na new_url w plikach tekstowych: filtr wstępny w wątkach, przepisywanie w puli procesów."""
+    start_time = time.monotonic()
+    replacements = build_url_replacements(old_urls, new_url)
+    needles = [old for old, _new in replacements]
+    candidates = find_rewrite_candidates(root_dirs, extra_files)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=REWRITE_PREFILTER_WORKERS) as executor:
+        hits = [path for path, hit in zip(candidates, executor.map(lambda p: _file_contains_any(p, needles), candidates)) if hit]
+    print(f"  Sprawdzono {len(candidates)} plików, stara domena występuje w {len(hits)}.")
+
+    rewritten_files = 0
+    total_replacements = 0
+    if hits:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=REWRITE_WORKERS, initializer=_init_rewrite_worker, initargs=(replacements,)) as executor:
+            for path, replaced, error in executor.map(_rewrite_file, hits, chunksize=16):
+                if error:
+                    emit_warning(f"Nie udało się przepisać pliku '{path}': {error}")
+                elif replaced:
+                    rewritten_files += 1
+                    total_replacements += replaced
+    print(f"  Przepisano {rewritten_files} plików ({total_replacements} zamian) w {time.monotonic() - start_time:.1f} s.")
+    return rewritten_files, total_replacements
+
+
+# --- Analiza tabeli opcji (autoload, transienty, osierocone postmeta) ---
+
+_SQL_ESCAPE_RE = re.compile(rb"\\(.)", re.DOTALL)
+_SQL_ESCAPES = {b"0": b"\x00", b"b": b"\b", b"n": b"\n", b"r": b"\r", b"t": b"\t", b"Z": b"\x1a"}
+
+def _unescape_sql_string(value):
+    if b"\\" in value:
+        value = _SQL_ESCAPE_RE.sub(lambda m: _SQL_ESCAPES.get(m.group(1), m.group(1)), value)
+    return value
+
+def split_sql_row(row, max_fields=None):
+    """Dzieli surową krotkę ze zrzutu (np. b"(1,'a',NULL)") na listę pól (bajty, None dla NULL).
+
+    Stringi są odescapowane. Przy podanym max_fields parsowanie kończy się po tylu polach.
+    """
+    fields = []
+    pos = 1
+    end = len(row) - 1 # Pomijamy nawias zamykający
+    while pos < end and (max_fields is None or len(fields) < max_fields):
+        while pos < end and row[pos] in b" \t\r\n":
+            pos += 1
+        quote = row[pos]
+        if quote == _BYTE_SINGLE_QUOTE or quote == ord('"'):
+            string_re = _SQL_IN_SINGLE_QUOTE_RE if quote == _BYTE_SINGLE_QUOTE else _SQL_IN_DOUBLE_QUOTE_RE
+            parts = []
+            pos += 1
+            while True:
+                m = string_re.search(row, pos)
+                if m is None:
+                    raise ValueError("Niezamknięty string w wierszu zrzutu SQL.")
+                if row[m.start()] == _BYTE_BACKSLASH:
+                    parts.append(row[pos:m.end() + 1])
+                    pos = m.end() + 1
+                elif m.end() < end and row[m.end()] == quote: # Podwojony cudzysłów, np. 'it''s'
+                    parts.append(row[pos:m.end()])
+                    pos = m.end() + 1
+                else:
+                    parts.append(row[pos:m.start()])
+                    pos = m.end()
+                    break
+            fields.append(_unescape_sql_string(b"".join(parts)))
+            comma = row.find(b",", pos, end)
+        else:
+            comma = row.find(b",", pos, end)
+            raw = row[pos:comma if comma != -1 else end].strip()
+            fields.append(None if raw.upper() == b"NULL" else raw)
+        if comma == -1:
+            break
+        pos = comma + 1
+    return fields
+
+def analyze_options_dump(sql_path, table_prefix, stop_event=None):
+    """Strumieniowo analizuje zrzut: rozmiar opcji autoload, transienty i osierocone wpisy postmeta.
+
+    Zakłada standardową kolejność kolumn tabel WordPressa. Zwraca słownik z wynikami analizy;
+    pod kluczem 'table_counts' są liczby wierszy wszystkich tabel zrzutu (do weryfikacji).
+    """
+    options_table = f"{table_prefix}options"
+    posts_table = f"{table_prefix}posts"
+    postmeta_table = f"{table_prefix}postmeta"
+    now = int(time.time())
+    report = {
+        'table': options_table, 'options': 0, 'autoload_count': 0, 'autoload_bytes': 0,
+        'transients': 0, 'transient_bytes': 0, 'expired_transients': 0,
+        'orphaned_postmeta': 0, 'parse_errors': 0,
+    }
+    autoloaded = []
+    post_ids = set()
+    postmeta_post_ids = {}
+
+    def on_row(table, row):
+        try:
+            if table == options_table:
+                fields = split_sql_row(row, 4)
+                name, value, autoload = fields[1] or b"", fields[2] or b"", (fields[3] or b"").lower()
+                report['options'] += 1
+                if autoload in AUTOLOAD_ENABLED_VALUES:
+                    report['autoload_count'] += 1
+                    report['autoload_bytes'] += len(value)
+                    autoloaded.append((len(value), name.decode('utf-8', 'replace')))
+                if name.startswith((b"_transient_", b"_site_transient_")):
+                    if b"_transient_timeout_" in name:
+                        if value.isdigit() and int(value) < now:
+                            report['expired_transients'] += 1
+                    else:
+                        report['transients'] += 1
+                        report['transient_bytes'] += len(value)
+            elif table == posts_table:
+                post_ids.add(split_sql_row(row, 1)[0])
+            elif table == postmeta_table:
+                post_id = split_sql_row(row, 2)[1]
+                postmeta_post_ids[post_id] = postmeta_post_ids.get(post_id, 0) + 1
+        except (ValueError, IndexError):
+            report['parse_errors'] += 1
+
+    report['table_counts'] = scan_sql_dump(sql_path, on_row, {options_table, posts_table, postmeta_table}, stop_event)
+    report['orphaned_postmeta'] = sum(count for post_id, count in postmeta_post_ids.items() if post_id not in post_ids)
+    report['largest'] = heapq.nlargest(OPTIONS_REPORT_TOP, autoloaded)
+    report['oversized'] = sorted(name for size, name in autoloaded if size > AUTOLOAD_OPTION_LIMIT)
+    return report
+
+def print_options_report(report):
+    print(f"\nAnaliza tabeli {report['table']} (ze zrzutu SQL):")
+    print(f"  Opcje: {report['options']}, autoload: {report['autoload_count']} ({report['autoload_bytes'] / 1048576:.2f} MB)")
+    if report['largest']:
+        print(f"  Największe opcje autoload:")
+        for size, name in report['largest']:
+            marker = " (ZA DUŻA)" if size > AUTOLOAD_OPTION_LIMIT else ""
+            print(f"    - {name}: {size / 1024:.1f} KB{marker}")
+    print(f"  Opcje autoload powyżej {AUTOLOAD_OPTION_LIMIT // 1024} KB: {len(report['oversized'])}")
+    print(f"  Transienty: {report['transients']} ({report['transient_bytes'] / 1048576:.2f} MB), wygasłe: {report['expired_transients']}")
+    print(f"  Osierocone wpisy postmeta (bez istniejącego posta): {report['orphaned_postmeta']}")
+    if report['parse_errors']:
+        emit_warning(f"Nie udało się sparsować {report['parse_errors']} wierszy zrzutu podczas analizy opcji.")
+
+def fix_options_bloat(report):
+    """Wyłącza autoload dla zbyt dużych opcji i usuwa wygasłe transienty w zaimportowanej bazie."""
+    if report['oversized']:
+        names = ", ".join(_quote_sql_string(name) for name in report['oversized'])
+        print(f"  Wyłączanie autoload dla {len(report['oversized'])} opcji większych niż {AUTOLOAD_OPTION_LIMIT // 1024} KB...")
+        result = run_command([WP_CLI_BIN, "db", "query",
+                              f"UPDATE {_quote_sql_identifier(report['table'])} SET autoload = 'no' WHERE option_name IN ({names})"] + WP_CLI_FLAGS, check=False)
+        if result is None or result.returncode != 0:
+            emit_warning("Nie udało się wyłączyć autoload dla dużych opcji.")
+    else:
+        print("  Brak zbyt dużych opcji autoload do wyłączenia.")
+    print("  Usuwanie wygasłych transientów...")
+    run_command([WP_CLI_BIN, "transient", "delete", "--expired"] + WP_CLI_FLAGS, check=False)
+
+
+# --- Optymalizacja obrazów w uploads (bezstratna rekompresja + WebP) ---
+
+_image_tools = None
+_image_cache = None
+
+def find_image_tools():
+    """Zwraca słownik {'jpegtran': ścieżka|None, 'optipng': ścieżka|None, 'cwebp': ścieżka|None}."""
+    return {tool: shutil.which(tool) for tool in ("jpegtran", "optipng", "cwebp")}
+
+def load_image_cache(cache_path):
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        emit_warning(f"Nie można odczytać cache obrazów '{cache_path}': {e}. Zaczynam z pustym cache.")
+        return {}
+
+def save_image_cache(cache_path, cache):
+    os.makedirs(os.path.dirname(cache_path), mode=0o700, exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+def _hash_file(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _init_image_worker(tools, cache):
+    global _image_tools, _image_cache
+    detach_event_stream_in_worker()
+    _image_tools = tools
+    _image_cache = cache
+    try:
+        os.nice(10) # Enkodery dziedziczą niski priorytet - migracja i serwer WWW mają pierwszeństwo
+    except OSError:
+        pass
+
+def _run_image_tool(command, tmp_path):
+    """Uruchamia narzędzie zapisujące wynik do tmp_path. Zwraca rozmiar wyniku lub None przy błędzie."""
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0 or not os.path.exists(tmp_path):
+        return None
+    return os.path.getsize(tmp_path)
+
+def _optimize_image(path, make_webp):
+    """Bezstratnie rekompresuje obraz i tworzy obok plik <nazwa>.webp (jeśli mniejszy).
+
+    Zwraca słownik z wynikiem: hash, rozmiary przed/po, rozmiar WebP, informacja o pominięciu lub błąd.
+    """
+    result = {'path': path, 'skipped': False, 'before': 0, 'after': 0, 'webp': 0, 'webp_created': False, 'hash': None, 'error': None}
+    webp_path = path + ".webp"
+    tmp_path = None
+    try:
+        content_hash = _hash_file(path)
+        cached = _image_cache.get(content_hash)
+        if cached is not None and (not make_webp or not cached.get('webp') or os.path.exists(webp_path)):
+            result['skipped'] = True
+            return result
+
+        result['before'] = result['after'] = os.path.getsize(path)
+        is_png = path.lower().endswith(".png")
+        fd, tmp_path = tempfile.mkstemp(prefix=".izolka-img-", dir=os.path.dirname(path))
+        os.close(fd)
+        # Bez usuwania metadanych: profile kolorów (iCCP, sRGB, gAMA, cHRM) w PNG i EXIF/ICC w JPEG zostają
+        if is_png and _image_tools.get('optipng'):
+            size = _run_image_tool([_image_tools['optipng'], "-quiet", "-o2", "-out", tmp_path, "-clobber", path], tmp_path)
+        elif not is_png and _image_tools.get('jpegtran'):
+            size = _run_image_tool([_image_tools['jpegtran'], "-copy", "all", "-optimize", "-progressive", "-outfile", tmp_path, path], tmp_path)
+        else:
+            size = None
+        if size and size < result['before']:
+            replace_with_temp_file(path, tmp_path)
+            result['after'] = size
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        webp_created = False
+        if make_webp and _image_tools.get('cwebp'):
+            fd, tmp_path = tempfile.mkstemp(prefix=".izolka-webp-", dir=os.path.dirname(path))
+            os.close(fd)
+            size = _run_image_tool([_image_tools['cwebp'], "-quiet", "-q", str(IMAGE_WEBP_QUALITY), "-m", "4", path, "-o", tmp_path], tmp_path)
+            if size and size < result['after']:
+                shutil.copystat(path, tmp_path)
+                os.replace(tmp_path, webp_path)
+                result['webp'] = size
+                webp_created = True
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        result['hash'] = _hash_file(path) if result['after'] != result['before'] else content_hash
+        result['webp_created'] = webp_created
+    except Exception as e:
+        result['error'] = str(e)
+        if tmp_path and os.path.exists(tmp_path):
+            try: os.remove(tmp_path)
+            except OSError: pass
+    return result
+
+def _record_image_result(report, cache, result):
+    if result['error']:
+        report['errors'] += 1
+        emit_warning(f"Optymalizacja obrazu '{result['path']}' nie powiodła się: {result['error']}")
+    elif result['skipped']:
+        report['skipped'] += 1
+    else:
+        report['processed'] += 1
+        report['bytes_saved'] += result['before'] - result['after']
+        if result['webp']:
+            report['webp_files'] += 1
+            report['webp_bytes_saved'] += result['after'] - result['webp']
+        cache[result['hash']] = {'webp': result['webp_created']}
+
+def optimize_uploads_images(uploads_dir, cache_path, make_webp=True, time_budget=IMAGE_TIME_BUDGET):
+    """Optymalizuje obrazy w uploads w puli procesów ograniczonej przez IMAGE_CPU_BUDGET i limit czasu.
+
+    Pliki, których hash jest w cache, są pomijane. Po przekroczeniu limitu czasu oczekujące zadania są anulowane.
+    """
+    start_time = time.monotonic()
+    tools = find_image_tools()
+    missing_tools = [tool for tool, tool_path in tools.items() if not tool_path]
+    if missing_tools:
+        emit_warning(f"Brak narzędzi {', '.join(missing_tools)} - odpowiednie kroki optymalizacji obrazów zostaną pominięte.")
+    if not any(tools.values()):
+        return None
+
+    images = []
+    for dirpath, _dirnames, filenames in os.walk(uploads_dir):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(dirpath, filename)
+                if not os.path.islink(path):
+                    images.append(path)
+    cache = load_image_cache(cache_path)
+    workers = max(1, int((os.cpu_count() or 1) * IMAGE_CPU_BUDGET))
+    print(f"  Obrazów do sprawdzenia: {len(images)}, procesy: {workers}, limit czasu: {time_budget} s.")
+
+    report = {'processed': 0, 'skipped': 0, 'errors': 0, 'bytes_saved': 0, 'webp_files': 0, 'webp_bytes_saved': 0, 'timed_out': False}
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_image_worker, initargs=(tools, cache))
+    futures = []
+    recorded = set()
+    try:
+        futures = [executor.submit(_optimize_image, path, make_webp) for path in images]
+        remaining = max(0, time_budget - (time.monotonic() - start_time))
+        try:
+            for done_count, future in enumerate(concurrent.futures.as_completed(futures, timeout=remaining), 1):
+                recorded.add(future)
+                _record_image_result(report, cache, future.result())
+                emit_progress("optimize_images", done_count, len(futures), unit="files", label="Obrazy:")
+        except concurrent.futures.TimeoutError:
+            report['timed_out'] = True
+            emit_warning(f"Przekroczono limit czasu optymalizacji obrazów ({time_budget} s). Pozostałe obrazy zostaną pominięte.")
+        except concurrent.futures.process.BrokenProcessPool as e:
+            # Np. proces roboczy zabity przez OOM killera - optymalizacja obrazów nie jest krytyczna dla migracji
+            report['errors'] += 1
+            emit_warning(f"Pula procesów optymalizacji obrazów uległa awarii ({e}). Pozostałe obrazy zostaną pominięte.")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        # Zadania trwające w chwili przekroczenia limitu zdążyły podmienić obrazy - ich wyniki też trafiają do cache i raportu
+        for future in futures:
+            if future not in recorded and future.done() and not future.cancelled() and future.exception() is None:
+                _record_image_result(report, cache, future.result())
+        save_image_cache(cache_path, cache)
+
+    print(f"  Przetworzono: {report['processed']}, pominięto (cache): {report['skipped']}, błędy: {report['errors']}.")
+    print(f"  Zaoszczędzono {report['bytes_saved'] / 1048576:.2f} MB rekompresją; utworzono {report['webp_files']} plików WebP "
+          f"(o {report['webp_bytes_saved'] / 1048576:.2f} MB mniejszych od oryginałów). Czas: {time.monotonic() - start_time:.1f} s.")
+    return report
+
+
+# --- Dziennik etapów migracji (wznawianie przez --resume) ---
+
+def path_fingerprint(path):
+    """Odcisk pliku do dziennika: [rozmiar, mtime_ns] lub None, jeśli plik nie istnieje."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+def new_journal(source_domain):
+    return {'version': JOURNAL_VERSION, 'source_domain': source_domain, 'stages': {}}
+
+def load_journal(source_domain):
+    """Wczytuje dziennik z katalogu tymczasowego. Zwraca None, jeśli go brak, jest uszkodzony lub dotyczy innej strony."""
+    try:
+        with open(FULL_JOURNAL_PATH, 'r', encoding='utf-8') as f:
+            journal = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, json.JSONDecodeError) as e:
+        emit_warning(f"Nie można odczytać dziennika migracji '{FULL_JOURNAL_PATH}': {e}")
+        return None
+    if journal.get('version') != JOURNAL_VERSION or journal.get('source_domain') != source_domain or not isinstance(journal.get('stages'), dict):
+        emit_warning(f"Dziennik migracji '{FULL_JOURNAL_PATH}' dotyczy innej migracji lub wersji skryptu - zostanie pominięty.")
+        return None
+    return journal
+
+def save_journal(journal):
+    """Zapisuje dziennik atomowo (plik tymczasowy + fsync + os.replace). Klucze zaczynające się od '_' nie są zapisywane."""
+    data = {key: value for key, value in journal.items() if not key.startswith('_')}
+    tmp_path = FULL_JOURNAL_PATH + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, FULL_JOURNAL_PATH)
+
+def _journal_value(value):
+    # Normalizacja przez JSON (np. krotki -> listy), aby porównanie z wczytanym dziennikiem było wiarygodne
+    return json.loads(json.dumps(value))
+
+def journal_stage_done(journal, stage, inputs=None, fingerprint_func=None):
+    """Zwraca True, jeśli etap jest w dzienniku z tymi samymi wejściami i aktualnym odciskiem wyników.
+
+    Pierwszy nieaktualny etap usuwa z dziennika siebie i wszystkie kolejne - od niego migracja jest wykonywana ponownie.
+    """
+    if '_restart_from' in journal:
+        emit_stage(stage, "start")
+        return False
+    record = journal['stages'].get(stage)
+    if (record is not None and record.get('inputs') == _journal_value(inputs)
+            and (fingerprint_func is None or record.get('fingerprint') == _journal_value(fingerprint_func()))):
+        journal.setdefault('_validated', []).append(stage)
+        print(f"[Wznawianie] Etap '{stage}' został już wykonany i jest aktualny - pomijam.")
+        emit_stage(stage, "skip")
+        return True
+
+    validated = journal.get('_validated', [])
+    journal['_restart_from'] = stage
+    journal['stages'] = {name: value for name, value in journal['stages'].items() if name in validated}
+    save_journal(journal)
+    if validated:
+        print(f"[Wznawianie] Kontynuacja migracji od etapu '{stage}'.")
+    emit_stage(stage, "start")
+    return False
+
+def journal_stage_complete(journal, stage, inputs=None, fingerprint=None, outputs=None):
+    journal['stages'][stage] = {
+        'completed_at': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'inputs': _journal_value(inputs),
+        'fingerprint': _journal_value(fingerprint),
+        'outputs': _journal_value(outputs),
+    }
+    save_journal(journal)
+    emit_stage(stage, "complete")
+
+def journal_stage_outputs(journal, stage):
+    return journal['stages'][stage].get('outputs') or {}
+
+def extract_backup():
+    """Rozpakowuje backup w FULL_TEMP_DIR i zwraca nazwę pliku SQL z bazą danych."""
+    print("Rozpakowywanie backupu...")
+    original_cwd_unzip = os.getcwd()
+    try:
+        os.chdir(FULL_TEMP_DIR)
+        result_unzip = run_command(["unzip", "-oqq", FINAL_ZIP_FILE])
+    finally:
+        os.chdir(original_cwd_unzip)
+
+    if result_unzip is None or result_unzip.returncode != 0:
+        raise Exception(f"Błąd rozpakowywania pliku {FINAL_ZIP_FILE}.")
+    print("Backup rozpakowany.")
+
+    print("Identyfikacja plików backupu...")
+    sql_files = [f for f in os.listdir(FULL_TEMP_DIR) if f.endswith('.sql') and f.startswith('database_')]
+    if len(sql_files) != 1:
+        raise Exception(f"Oczekiwano 1 pliku SQL z backupu (np. database_XXXX.sql), znaleziono {len(sql_files)}: {sql_files} w {FULL_TEMP_DIR}")
+    print(f"Znaleziono plik bazy danych: {os.path.join(FULL_TEMP_DIR, sql_files[0])}")
+    return sql_files[0]
+
+def list_backup_top_level_items(zip_path):
+    """Zwraca posortowaną listę elementów najwyższego poziomu archiwum (np. wp-content, .htaccess)."""
+    with zipfile.ZipFile(zip_path) as zf:
+        names = {name.lstrip('/').removeprefix('./').split('/', 1)[0] for name in zf.namelist()}
+    return sorted(name for name in names if name)
+
+def get_db_table_count():
+    rows = _wp_db_query_rows("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()")
+    return int(rows[0][0]) if rows else None
+
+
 # --- Główny skrypt ---
 def main():
     parser = argparse.ArgumentParser(description="Skrypt migracji WordPressa z backupu Izolka Migrate.")
     parser.add_argument("source_url", help="URL strony źródłowej (bez http/https), np. cbmc.pl")
     parser.add_argument("api_key", help="Klucz API wtyczki Izolka Migrate ze strony źródłowej.")
+    parser.add_argument("--resume", action="store_true", help="Wznów przerwaną migrację: pomiń etapy zapisane w dzienniku w katalogu tymczasowym, które są nadal aktualne.")
+    parser.add_argument("--fix-autoload", action="store_true", help=f"Po imporcie wyłącz autoload dla opcji większych niż {AUTOLOAD_OPTION_LIMIT // 1024} KB i usuń wygasłe transienty.")
+    parser.add_argument("--no-file-rewrite", action="store_true", help="Nie podmieniaj starej domeny w plikach motywów, wtyczek, uploads i .htaccess.")
+    parser.add_argument("--optimize-images", action="store_true", help=f"Bezstratnie zoptymalizuj obrazy JPEG/PNG w uploads i wygeneruj obok pliki WebP (wymaga jpegtran, optipng, cwebp). Cache przetworzonych obrazów: {FULL_IMAGE_CACHE_PATH}.")
+    parser.add_argument("--image-time-budget", type=int, default=IMAGE_TIME_BUDGET, help=f"Limit czasu (s) optymalizacji obrazów (domyślnie {IMAGE_TIME_BUDGET}).")
+    parser.add_argument("--events", metavar="CEL", type=events_target_arg, help="Zapisuj zdarzenia (etapy, postęp, ostrzeżenia, logi) jako JSON Lines: ścieżka pliku, 'unix:/ścieżka' lub 'tcp:host:port'.")
+    parser.add_argument("--no-verify", action="store_true", help="Pomiń weryfikację plików (CRC32 względem ZIP) i liczby wierszy tabel po migracji.")
     args = parser.parse_args()
 
     SOURCE_DOMAIN = args.source_url
@@ -208,10 +1277,14 @@ def main():
 
     exit_code = 0
     NEW_URL = ""
+    analysis_stop = threading.Event() # Przerywa równoległą analizę zrzutu SQL przy błędzie
     fix_permissions_script_path = os.path.join(WP_ROOT_DIR, FIX_PERMISSIONS_SCRIPT_NAME) # Ścieżka do tymczasowego skryptu
 
     global WP_CLI_BIN # Deklarujemy zamiar modyfikacji globalnej zmiennej
 
+    start_event_stream(args.events)
+    emit_event("run", status="start", source_domain=SOURCE_DOMAIN, resume=args.resume)
+
     try:
         print(f"Przechodzenie do katalogu WordPressa docelowego: {WP_ROOT_DIR}")
         if not os.path.isdir(WP_ROOT_DIR):
@@ -223,7 +1296,7 @@ def main():
         if not shutil.which("unzip"):
             raise Exception("Wymagany 'unzip' nie jest zainstalowany.")
         if not shutil.which("bash"): # Sprawdzamy czy jest bash do uruchomienia skryptu .sh
-             print("Ostrzeżenie: Komenda 'bash' nie znaleziona. Skrypt naprawy uprawnień może nie zadziałać.", file=sys.stderr)
+             emit_warning("Komenda 'bash' nie znaleziona. Skrypt naprawy uprawnień może nie zadziałać.")
 
 
         # --- Logika znajdowania WP-CLI ---
@@ -284,131 +1357,172 @@ def main():
         print(f"Jest to operacja DESTRUKCYJNA i NIEODWRACALNA.")
         print(f"Rozpoczynanie automatycznej migracji...\n")
 
-        print(f"Przygotowanie tymczasowego katalogu: {FULL_TEMP_DIR}")
-        if os.path.exists(FULL_TEMP_DIR): shutil.rmtree(FULL_TEMP_DIR)
-        os.makedirs(FULL_TEMP_DIR)
-        print("Katalog tymczasowy OK.")
-
-        print(f"Wywoływanie backupu na stronie źródłowej: {TRIGGER_ENDPOINT}")
-        headers = {"X-API-Key": API_KEY}
-        try:
-            trigger_response = requests.post(TRIGGER_ENDPOINT, headers=headers, timeout=120) 
-            trigger_response.raise_for_status() 
-            trigger_data = trigger_response.json()
-        except requests.exceptions.Timeout:
-            raise Exception(f"Przekroczono limit czasu (timeout) podczas wywoływania triggera na {TRIGGER_ENDPOINT}. Serwer źródłowy może być przeciążony lub backup trwa zbyt długo.")
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"Błąd połączenia lub HTTP podczas wywoływania triggera: {e}")
-        except json.JSONDecodeError:
-            raise Exception(f"Nie udało się zdekodować odpowiedzi JSON z triggera. Odpowiedź: {trigger_response.text}")
-
-        if not trigger_data.get('success'):
-            raise Exception(f"Błąd triggera: {trigger_data.get('message', 'Nieznany błąd')}")
-        backup_filename = trigger_data['filename']
-        backup_filesize = int(trigger_data['file_size'])
-        print(f"Informacje o backupie: Plik: {backup_filename}, Rozmiar: {backup_filesize} bajtów.")
-
-        print(f"Pobieranie backupu z: {DOWNLOAD_ENDPOINT}")
-        downloaded_size = 0
-        if backup_filesize == 0:
-            with open(FULL_FINAL_ZIP_PATH, 'wb') as f: pass
-            print_progress(0,0)
-            print("\nPusty plik utworzony (rozmiar 0).")
+        journal = load_journal(SOURCE_DOMAIN) if args.resume else None
+        if args.resume and journal is None:
+            print(f"Nie znaleziono ważnego dziennika migracji ({FULL_JOURNAL_PATH}) dla '{SOURCE_DOMAIN}'. Migracja zostanie wykonana od początku.")
+        if journal is None:
+            print(f"Przygotowanie tymczasowego katalogu: {FULL_TEMP_DIR}")
+            if os.path.exists(FULL_TEMP_DIR): shutil.rmtree(FULL_TEMP_DIR)
+            os.makedirs(FULL_TEMP_DIR)
+            journal = new_journal(SOURCE_DOMAIN)
+            save_journal(journal)
+            print("Katalog tymczasowy OK.")
         else:
+            print(f"Wznawianie migracji na podstawie dziennika: {FULL_JOURNAL_PATH}")
+
+        # URL docelowy odczytujemy przed pobraniem backupu - to pierwszy etap dziennika, więc ponowne wykonanie
+        # późniejszych etapów nigdy go nie usuwa (po imporcie bazy 'siteurl' wskazuje już na domenę źródłową)
+        if not journal_stage_done(journal, "target_url"):
+            print(f"Pobieranie docelowego URL strony z {WP_ROOT_DIR}...")
+            result_siteurl = run_command([WP_CLI_BIN, "option", "get", "siteurl"] + WP_CLI_FLAGS)
+            if result_siteurl is None or result_siteurl.returncode != 0 or not result_siteurl.stdout:
+                raise Exception(f"Błąd krytyczny: Nie udało się pobrać 'siteurl' z docelowej instalacji WP. stdout: '{result_siteurl.stdout if result_siteurl else ''}', stderr: '{result_siteurl.stderr if result_siteurl else ''}'")
+            NEW_URL = result_siteurl.stdout.strip()
+            if not NEW_URL:
+                raise Exception(f"Błąd krytyczny: Pobrany 'siteurl' jest pusty.")
+            journal_stage_complete(journal, "target_url", outputs={'new_url': NEW_URL})
+        NEW_URL = journal_stage_outputs(journal, "target_url")['new_url']
+        print(f"Docelowy URL strony (nowy): {NEW_URL}")
+
+        download_inputs = {'source_domain': SOURCE_DOMAIN}
+        if not journal_stage_done(journal, "download", download_inputs, lambda: {'zip': path_fingerprint(FULL_FINAL_ZIP_PATH)}):
+            # Pozostałości poprzedniej próby (poza dziennikiem) nie mogą trafić do nowej migracji
+            for item_name in os.listdir(FULL_TEMP_DIR):
+                if item_name == JOURNAL_FILE_NAME: continue
+                item_path = os.path.join(FULL_TEMP_DIR, item_name)
+                if os.path.isdir(item_path) and not os.path.islink(item_path): shutil.rmtree(item_path)
+                else: os.remove(item_path)
+
+            print(f"Wywoływanie backupu na stronie źródłowej: {TRIGGER_ENDPOINT}")
+            headers = {"X-API-Key": API_KEY}
             try:
-                with requests.get(DOWNLOAD_ENDPOINT, headers=headers, stream=True, timeout=600) as r: 
-                    r.raise_for_status()
-                    with open(FULL_FINAL_ZIP_PATH, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
-                            f.write(chunk)
-                            downloaded_size += len(chunk)
-                            print_progress(downloaded_size, backup_filesize)
-                print("\nPobieranie zakończone.")
+                trigger_response = requests.post(TRIGGER_ENDPOINT, headers=headers, timeout=120)
+                trigger_response.raise_for_status()
+                trigger_data = trigger_response.json()
             except requests.exceptions.Timeout:
-                raise Exception(f"Przekroczono limit czasu (timeout) podczas pobierania pliku z {DOWNLOAD_ENDPOINT}.")
+                raise Exception(f"Przekroczono limit czasu (timeout) podczas wywoływania triggera na {TRIGGER_ENDPOINT}. Serwer źródłowy może być przeciążony lub backup trwa zbyt długo.")
             except requests.exceptions.RequestException as e:
-                 raise Exception(f"Błąd połączenia lub HTTP podczas pobierania pliku: {e}")
-
-
-        ACTUAL_DOWNLOADED_SIZE = get_file_size(FULL_FINAL_ZIP_PATH)
-        if ACTUAL_DOWNLOADED_SIZE is None or ACTUAL_DOWNLOADED_SIZE != backup_filesize:
-            raise Exception(f"Rozmiar pobranego pliku ({ACTUAL_DOWNLOADED_SIZE}) nie zgadza się z oczekiwanym ({backup_filesize}).")
-        print(f"Backup pobrany pomyślnie do: {FULL_FINAL_ZIP_PATH}")
+                raise Exception(f"Błąd połączenia lub HTTP podczas wywoływania triggera: {e}")
+            except json.JSONDecodeError:
+                raise Exception(f"Nie udało się zdekodować odpowiedzi JSON z triggera. Odpowiedź: {trigger_response.text}")
+
+            if not trigger_data.get('success'):
+                raise Exception(f"Błąd triggera: {trigger_data.get('message', 'Nieznany błąd')}")
+            backup_filename = trigger_data['filename']
+            backup_filesize = int(trigger_data['file_size'])
+            print(f"Informacje o backupie: Plik: {backup_filename}, Rozmiar: {backup_filesize} bajtów.")
+
+            print(f"Pobieranie backupu z: {DOWNLOAD_ENDPOINT}")
+            downloaded_size = 0
+            if backup_filesize == 0:
+                with open(FULL_FINAL_ZIP_PATH, 'wb') as f: pass
+                emit_progress("download", 0, 0, label="Pobieranie:")
+                print("Pusty plik utworzony (rozmiar 0).")
+            else:
+                try:
+                    with requests.get(DOWNLOAD_ENDPOINT, headers=headers, stream=True, timeout=600) as r:
+                        r.raise_for_status()
+                        with open(FULL_FINAL_ZIP_PATH, 'wb') as f:
+                            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                                f.write(chunk)
+                                downloaded_size += len(chunk)
+                                emit_progress("download", downloaded_size, backup_filesize, label="Pobieranie:")
+                    print("Pobieranie zakończone.")
+                except requests.exceptions.Timeout:
+                    raise Exception(f"Przekroczono limit czasu (timeout) podczas pobierania pliku z {DOWNLOAD_ENDPOINT}.")
+                except requests.exceptions.RequestException as e:
+                     raise Exception(f"Błąd połączenia lub HTTP podczas pobierania pliku: {e}")
+
+
+            ACTUAL_DOWNLOADED_SIZE = get_file_size(FULL_FINAL_ZIP_PATH)
+            if ACTUAL_DOWNLOADED_SIZE is None or ACTUAL_DOWNLOADED_SIZE != backup_filesize:
+                raise Exception(f"Rozmiar pobranego pliku ({ACTUAL_DOWNLOADED_SIZE}) nie zgadza się z oczekiwanym ({backup_filesize}).")
+            print(f"Backup pobrany pomyślnie do: {FULL_FINAL_ZIP_PATH}")
+            journal_stage_complete(journal, "download", download_inputs, {'zip': path_fingerprint(FULL_FINAL_ZIP_PATH)},
+                                   {'filename': backup_filename, 'file_size': backup_filesize})
+
+        extract_inputs = {'zip': path_fingerprint(FULL_FINAL_ZIP_PATH)}
+        if not journal_stage_done(journal, "extract", extract_inputs,
+                                  lambda: {'sql': path_fingerprint(os.path.join(FULL_TEMP_DIR, journal_stage_outputs(journal, "extract").get('sql_file', '')))}):
+            sql_file_name = extract_backup()
+            journal_stage_complete(journal, "extract", extract_inputs, {'sql': path_fingerprint(os.path.join(FULL_TEMP_DIR, sql_file_name))},
+                                   {'sql_file': sql_file_name, 'items': list_backup_top_level_items(FULL_FINAL_ZIP_PATH)})
+        extract_outputs = journal_stage_outputs(journal, "extract")
+        SQL_FILE_PATH = os.path.join(FULL_TEMP_DIR, extract_outputs['sql_file'])
+        print(f"Plik bazy danych backupu: {SQL_FILE_PATH}")
 
-        print("Rozpakowywanie backupu...")
-        original_cwd_unzip = os.getcwd()
-        try:
-            os.chdir(FULL_TEMP_DIR) 
-            result_unzip = run_command(["unzip", "-oqq", FINAL_ZIP_FILE]) 
-        finally:
-            os.chdir(original_cwd_unzip) 
-
-        if result_unzip is None or result_unzip.returncode != 0:
-            raise Exception(f"Błąd rozpakowywania pliku {FINAL_ZIP_FILE}.")
-        print("Backup rozpakowany.")
-
-        print("Identyfikacja plików backupu...")
-        sql_files = [f for f in os.listdir(FULL_TEMP_DIR) if f.endswith('.sql') and f.startswith('database_')]
-        if len(sql_files) != 1:
-            raise Exception(f"Oczekiwano 1 pliku SQL z backupu (np. database_XXXX.sql), znaleziono {len(sql_files)}: {sql_files} w {FULL_TEMP_DIR}")
-        SQL_FILE_PATH = os.path.join(FULL_TEMP_DIR, sql_files[0])
-        print(f"Znaleziono plik bazy danych: {SQL_FILE_PATH}")
+        items_to_exclude_from_move = [
+            os.path.basename(SQL_FILE_PATH),
+            FINAL_ZIP_FILE,
+            os.path.basename(FULL_TEMP_WP_CONFIG_PATH),
+            "wp-config.php",
+            JOURNAL_FILE_NAME,
+            JOURNAL_FILE_NAME + ".tmp"
+        ]
+        items_to_move = [item for item in extract_outputs['items'] if item not in items_to_exclude_from_move]
 
         print(f"Ustawiam katalog roboczy na {WP_ROOT_DIR} dla operacji WP-CLI.")
         os.chdir(WP_ROOT_DIR)
 
 
         print("Rozpoczęcie migracji bazy danych...")
-        print(f"Pobieranie docelowego URL strony z {WP_ROOT_DIR}...")
-        result_siteurl = run_command([WP_CLI_BIN, "option", "get", "siteurl"] + WP_CLI_FLAGS)
-        if result_siteurl is None or result_siteurl.returncode != 0 or not result_siteurl.stdout:
-            raise Exception(f"Błąd krytyczny: Nie udało się pobrać 'siteurl' z docelowej instalacji WP. stdout: '{result_siteurl.stdout if result_siteurl else ''}', stderr: '{result_siteurl.stderr if result_siteurl else ''}'")
-        NEW_URL = result_siteurl.stdout.strip()
-        if not NEW_URL:
-            raise Exception(f"Błąd krytyczny: Pobrany 'siteurl' jest pusty.")
-        print(f"Docelowy URL strony (nowy): {NEW_URL}")
-
-        print(f"Krok 1 DB: Wstępne sprawdzanie/tworzenie bazy danych (jeśli nie istnieje)...")
-        result_db_create_initial = run_command([WP_CLI_BIN, "db", "create"] + WP_CLI_FLAGS, check=False)
-        if result_db_create_initial is not None:
-            if result_db_create_initial.returncode == 0: print("Baza danych utworzona lub potwierdzono istnienie (kod 0).")
-            elif result_db_create_initial.stderr and "database exists" in result_db_create_initial.stderr.lower(): print("Baza danych już istniała (komunikat od MySQL).")
+        backup_wp_config_path = os.path.join(FULL_TEMP_DIR, "wp-config.php")
+        target_wp_config_path = WP_CONFIG_DEST_PATH_IN_ROOT
+        analysis_prefix = (get_table_prefix_from_config(backup_wp_config_path) if os.path.exists(backup_wp_config_path) else None) or "wp_"
+        options_report = None
+
+        db_import_inputs = {'sql': path_fingerprint(SQL_FILE_PATH)}
+        if not journal_stage_done(journal, "db_import", db_import_inputs, lambda: {'tables': get_db_table_count()}):
+            print(f"Krok 1 DB: Wstępne sprawdzanie/tworzenie bazy danych (jeśli nie istnieje)...")
+            result_db_create_initial = run_command([WP_CLI_BIN, "db", "create"] + WP_CLI_FLAGS, check=False)
+            if result_db_create_initial is not None:
+                if result_db_create_initial.returncode == 0: print("Baza danych utworzona lub potwierdzono istnienie (kod 0).")
+                elif result_db_create_initial.stderr and "database exists" in result_db_create_initial.stderr.lower(): print("Baza danych już istniała (komunikat od MySQL).")
+                else:
+                     raise Exception(f"Początkowe 'wp db create' nie powiodło się z nieoczekiwanym błędem (kod: {result_db_create_initial.returncode}). stderr: {result_db_create_initial.stderr}")
             else:
-                 raise Exception(f"Początkowe 'wp db create' nie powiodło się z nieoczekiwanym błędem (kod: {result_db_create_initial.returncode}). stderr: {result_db_create_initial.stderr}")
-        else:
-            raise Exception(f"Krytyczny błąd systemowy podczas początkowego 'wp db create'.")
+                raise Exception(f"Krytyczny błąd systemowy podczas początkowego 'wp db create'.")
 
 
-        print("Krok 2 DB: Usuwanie istniejących tabel (drop)...")
-        result_db_drop = run_command([WP_CLI_BIN, "db", "drop"] + WP_CLI_FLAGS + ["--yes"])
-        if result_db_drop is None or result_db_drop.returncode != 0:
-            raise Exception(f"Nie udało się wykonać 'wp db drop' (kod: {result_db_drop.returncode if result_db_drop else 'brak obiektu result'}). stderr: {result_db_drop.stderr if result_db_drop else ''}")
-        print("Operacja 'wp db drop' zakończona.")
+            print("Krok 2 DB: Usuwanie istniejących tabel (drop)...")
+            result_db_drop = run_command([WP_CLI_BIN, "db", "drop"] + WP_CLI_FLAGS + ["--yes"])
+            if result_db_drop is None or result_db_drop.returncode != 0:
+                raise Exception(f"Nie udało się wykonać 'wp db drop' (kod: {result_db_drop.returncode if result_db_drop else 'brak obiektu result'}). stderr: {result_db_drop.stderr if result_db_drop else ''}")
+            print("Operacja 'wp db drop' zakończona.")
 
-        print("Krok 3 DB: Ponowne tworzenie bazy danych (jeśli 'drop' ją usunął)...")
-        result_db_create_after_drop = run_command([WP_CLI_BIN, "db", "create"] + WP_CLI_FLAGS, check=False)
-        if result_db_create_after_drop is not None:
-            if result_db_create_after_drop.returncode == 0: print("Baza danych ponownie utworzona lub potwierdzono istnienie.")
-            elif result_db_create_after_drop.stderr and "database exists" in result_db_create_after_drop.stderr.lower(): print("Baza danych już istniała (potwierdzone po 'wp db drop').")
+            print("Krok 3 DB: Ponowne tworzenie bazy danych (jeśli 'drop' ją usunął)...")
+            result_db_create_after_drop = run_command([WP_CLI_BIN, "db", "create"] + WP_CLI_FLAGS, check=False)
+            if result_db_create_after_drop is not None:
+                if result_db_create_after_drop.returncode == 0: print("Baza danych ponownie utworzona lub potwierdzono istnienie.")
+                elif result_db_create_after_drop.stderr and "database exists" in result_db_create_after_drop.stderr.lower(): print("Baza danych już istniała (potwierdzone po 'wp db drop').")
+                else:
+                    raise Exception(f"Ponowne 'wp db create' po 'wp db drop' nie powiodło się (kod: {result_db_create_after_drop.returncode}). stderr: {result_db_create_after_drop.stderr}")
             else:
-                raise Exception(f"Ponowne 'wp db create' po 'wp db drop' nie powiodło się (kod: {result_db_create_after_drop.returncode}). stderr: {result_db_create_after_drop.stderr}")
-        else:
-            raise Exception(f"Krytyczny błąd systemowy podczas ponownego 'wp db create'.")
+                raise Exception(f"Krytyczny błąd systemowy podczas ponownego 'wp db create'.")
 
 
-        print(f"Krok 4 DB: Importowanie bazy danych z backupu: {SQL_FILE_PATH}")
-        if not os.path.exists(SQL_FILE_PATH): raise Exception(f"Plik SQL '{SQL_FILE_PATH}' nie istnieje! Sprawdź zawartość {FULL_TEMP_DIR}.")
-        result_db_import = run_command([WP_CLI_BIN, "db", "import", SQL_FILE_PATH] + WP_CLI_FLAGS)
-        if result_db_import is None or result_db_import.returncode != 0:
-            raise Exception(f"Nie udało się zaimportować bazy danych ('wp db import {SQL_FILE_PATH}'). stderr: {result_db_import.stderr if result_db_import else ''}")
-        print("Baza danych zaimportowana.")
+            print(f"Krok 4 DB: Importowanie bazy danych z backupu: {SQL_FILE_PATH}")
+            if not os.path.exists(SQL_FILE_PATH): raise Exception(f"Plik SQL '{SQL_FILE_PATH}' nie istnieje! Sprawdź zawartość {FULL_TEMP_DIR}.")
+            # Analiza opcji czyta zrzut równolegle z importem
+            analysis_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            options_analysis_future = analysis_executor.submit(analyze_options_dump, SQL_FILE_PATH, analysis_prefix, analysis_stop)
+            analysis_executor.shutdown(wait=False)
+            result_db_import = run_command([WP_CLI_BIN, "db", "import", SQL_FILE_PATH] + WP_CLI_FLAGS)
+            if result_db_import is None or result_db_import.returncode != 0:
+                raise Exception(f"Nie udało się zaimportować bazy danych ('wp db import {SQL_FILE_PATH}'). stderr: {result_db_import.stderr if result_db_import else ''}")
+            print("Baza danych zaimportowana.")
+            journal_stage_complete(journal, "db_import", db_import_inputs, {'tables': get_db_table_count()})
 
-        print("\nSprawdzanie i aktualizacja prefixu tabel w wp-config.php...")
-        backup_wp_config_path = os.path.join(FULL_TEMP_DIR, "wp-config.php") 
-        target_wp_config_path = WP_CONFIG_DEST_PATH_IN_ROOT     
+            try:
+                options_report = options_analysis_future.result()
+                print_options_report(options_report)
+            except Exception as e:
+                emit_warning(f"Analiza tabeli opcji nie powiodła się: {e}")
 
+        # Sprawdzenie prefixu jest tanie i idempotentne - wykonywane przy każdym uruchomieniu, także przy wznowieniu
+        print("\nSprawdzanie i aktualizacja prefixu tabel w wp-config.php...")
         if not os.path.exists(backup_wp_config_path):
-            print(f"Ostrzeżenie: Nie znaleziono pliku wp-config.php w backupie ({backup_wp_config_path}). Nie można automatycznie zaktualizować prefixu tabel. Zakładam, że obecny prefix w {target_wp_config_path} jest poprawny.", file=sys.stderr)
+            emit_warning(f"Nie znaleziono pliku wp-config.php w backupie ({backup_wp_config_path}). Nie można automatycznie zaktualizować prefixu tabel. Zakładam, że obecny prefix w {target_wp_config_path} jest poprawny.")
         else:
             backup_table_prefix = get_table_prefix_from_config(backup_wp_config_path)
             if backup_table_prefix:
@@ -425,140 +1539,208 @@ def main():
                 else:
                     print("Prefix tabeli w docelowym wp-config.php jest już zgodny z backupem.")
             else:
-                print(f"Ostrzeżenie: Nie udało się odczytać prefixu tabeli z {backup_wp_config_path} (z backupu). Zakładam, że obecny prefix w {target_wp_config_path} jest poprawny.", file=sys.stderr)
+                emit_warning(f"Nie udało się odczytać prefixu tabeli z {backup_wp_config_path} (z backupu). Zakładam, że obecny prefix w {target_wp_config_path} jest poprawny.")
 
-        print(f"\nAktualizacja URL-i w bazie danych: zamiana '{SOURCE_DOMAIN}' i jego wariacji na '{NEW_URL}'...")
-        search_replace_base_cmd = [WP_CLI_BIN, "search-replace"]
-        search_replace_options = ["--all-tables-with-prefix", "--recurse-objects", "--skip-columns=guid", "--precise", "--report-changed-only"] + WP_CLI_FLAGS
-        
         normalized_source_domain = SOURCE_DOMAIN.replace("www.", "")
-        
+
         urls_to_replace = [
             f"http://{normalized_source_domain}", f"https://{normalized_source_domain}",
             f"http://www.{normalized_source_domain}", f"https://www.{normalized_source_domain}"
         ]
         urls_to_replace = sorted(list(set(urls_to_replace)))
 
+        search_replace_inputs = {'urls': urls_to_replace, 'new_url': NEW_URL}
+        if not journal_stage_done(journal, "search_replace", search_replace_inputs):
+            print(f"\nAktualizacja URL-i w bazie danych: zamiana '{SOURCE_DOMAIN}' i jego wariacji na '{NEW_URL}'...")
+            search_replace_base_cmd = [WP_CLI_BIN, "search-replace"]
+            search_replace_options = ["--all-tables-with-prefix", "--recurse-objects", "--skip-columns=guid", "--precise", "--report-changed-only"] + WP_CLI_FLAGS
 
-        for old_url in urls_to_replace:
-            print(f"  Zamiana: '{old_url}' -> '{NEW_URL}'")
-            run_command(search_replace_base_cmd + [old_url, NEW_URL] + search_replace_options, check=False)
-
-        print("Wyszukiwanie i zamiana URL-i w bazie danych zakończona.")
+            for old_url in urls_to_replace:
+                print(f"  Zamiana: '{old_url}' -> '{NEW_URL}'")
+                run_command(search_replace_base_cmd + [old_url, NEW_URL] + search_replace_options, check=False)
 
-        print("Rozpoczęcie migracji plików...")
-        print(f"Zachowywanie docelowego wp-config.php (z potencjalnie zaktualizowanym prefixem) do {FULL_TEMP_WP_CONFIG_PATH}...")
-        if not os.path.exists(target_wp_config_path): 
-            raise Exception(f"Nie znaleziono docelowego wp-config.php w {target_wp_config_path}!")
-        shutil.copy2(target_wp_config_path, FULL_TEMP_WP_CONFIG_PATH)
-        print("Docelowy wp-config.php zachowany w katalogu tymczasowym.")
+            print("Wyszukiwanie i zamiana URL-i w bazie danych zakończona.")
+            journal_stage_complete(journal, "search_replace", search_replace_inputs)
 
         target_wp_content_full_path = os.path.join(WP_ROOT_DIR, WP_CONTENT_DIR_NAME)
-        print(f"Usuwanie istniejącego katalogu {target_wp_content_full_path} (jeśli istnieje)...")
-        if os.path.isdir(target_wp_content_full_path):
-            shutil.rmtree(target_wp_content_full_path)
-            print(f"Katalog {target_wp_content_full_path} usunięty.")
-        elif os.path.exists(target_wp_content_full_path): 
-             os.remove(target_wp_content_full_path)
-             print(f"Plik {target_wp_content_full_path} (oczekiwano katalogu) usunięty.")
-        else:
-            print(f"Katalog {target_wp_content_full_path} nie istniał.")
+        file_move_inputs = {'items': items_to_move}
+        if not journal_stage_done(journal, "file_move", file_move_inputs,
+                                  lambda: {'placed': [item for item in items_to_move if os.path.lexists(os.path.join(WP_ROOT_DIR, item))]}):
+            print("Rozpoczęcie migracji plików...")
+            missing_in_temp = [item for item in items_to_move if not os.path.lexists(os.path.join(FULL_TEMP_DIR, item))]
+            if missing_in_temp:
+                # Poprzednia próba przeniosła część elementów - odtwarzamy je z archiwum, zanim cokolwiek zostanie usunięte
+                print(f"Brak {len(missing_in_temp)} elementów backupu w katalogu tymczasowym (np. {missing_in_temp[0]}). Ponowne rozpakowanie archiwum...")
+                extract_backup()
+
+            print(f"Zachowywanie docelowego wp-config.php (z potencjalnie zaktualizowanym prefixem) do {FULL_TEMP_WP_CONFIG_PATH}...")
+            if not os.path.exists(target_wp_config_path):
+                raise Exception(f"Nie znaleziono docelowego wp-config.php w {target_wp_config_path}!")
+            shutil.copy2(target_wp_config_path, FULL_TEMP_WP_CONFIG_PATH)
+            print("Docelowy wp-config.php zachowany w katalogu tymczasowym.")
+
+            print(f"Usuwanie istniejącego katalogu {target_wp_content_full_path} (jeśli istnieje)...")
+            if os.path.isdir(target_wp_content_full_path):
+                shutil.rmtree(target_wp_content_full_path)
+                print(f"Katalog {target_wp_content_full_path} usunięty.")
+            elif os.path.exists(target_wp_content_full_path):
+                 os.remove(target_wp_content_full_path)
+                 print(f"Plik {target_wp_content_full_path} (oczekiwano katalogu) usunięty.")
+            else:
+                print(f"Katalog {target_wp_content_full_path} nie istniał.")
+
+            print(f"Przenoszenie zawartości z backupu ({FULL_TEMP_DIR}) do {WP_ROOT_DIR}...")
+            moved_items_count = 0
+            for item_name in os.listdir(FULL_TEMP_DIR):
+                if item_name not in items_to_exclude_from_move:
+                    source_item_path = os.path.join(FULL_TEMP_DIR, item_name)
+                    destination_item_path = os.path.join(WP_ROOT_DIR, item_name)
+
+                    if os.path.exists(destination_item_path):
+                        emit_warning(f"Element docelowy {destination_item_path} istnieje. Zostanie usunięty i nadpisany przez element z backupu.")
+                        if os.path.isdir(destination_item_path):
+                            shutil.rmtree(destination_item_path)
+                        else:
+                            os.remove(destination_item_path)
+
+                    shutil.move(source_item_path, destination_item_path)
+                    moved_items_count +=1
+                    print(f"Przeniesiono: {item_name} z {source_item_path} do {destination_item_path}")
+
+            if moved_items_count == 0 :
+                 emit_warning(f"Nie przeniesiono żadnych głównych elementów z katalogu backupu (np. wp-content). Sprawdź strukturę backupu w {FULL_TEMP_DIR}.")
+            print("Pliki/katalogi z backupu przeniesione.")
+
+            print(f"Przywracanie oryginalnego (ale zaktualizowanego o prefix) wp-config.php z {FULL_TEMP_WP_CONFIG_PATH} do {target_wp_config_path}...")
+            shutil.copy2(FULL_TEMP_WP_CONFIG_PATH, target_wp_config_path)
+            print(f"Plik wp-config.php przywrócony do {target_wp_config_path}.")
+            journal_stage_complete(journal, "file_move", file_move_inputs,
+                                   {'placed': [item for item in items_to_move if os.path.lexists(os.path.join(WP_ROOT_DIR, item))]})
+
+        verify_inputs = {'enabled': not args.no_verify}
+        if not journal_stage_done(journal, "verify", verify_inputs):
+            if args.no_verify:
+                print("\nPominięto weryfikację integralności (--no-verify).")
+            else:
+                print("\nWeryfikacja integralności plików i bazy danych...")
+                # Liczby wierszy ze zrzutu są już znane z analizy opcji, jeśli import odbył się w tym uruchomieniu
+                dump_counts = options_report['table_counts'] if options_report is not None else None
+                if not verify_migration(FULL_FINAL_ZIP_PATH, WP_ROOT_DIR, items_to_exclude_from_move, SQL_FILE_PATH, dump_counts):
+                    emit_warning("Weryfikacja wykazała rozbieżności. Migracja jest kontynuowana - sprawdź raport powyżej.")
+            journal_stage_complete(journal, "verify", verify_inputs)
+
+        # Po weryfikacji - usunięte wygasłe transienty nie mogą zaburzyć porównania liczby wierszy ze zrzutem
+        fix_autoload_inputs = {'enabled': args.fix_autoload}
+        if not journal_stage_done(journal, "fix_autoload", fix_autoload_inputs):
+            if args.fix_autoload:
+                if options_report is None:
+                    print("Analiza tabeli opcji ze zrzutu SQL (wymagana przez --fix-autoload)...")
+                    try:
+                        options_report = analyze_options_dump(SQL_FILE_PATH, analysis_prefix)
+                        print_options_report(options_report)
+                    except Exception as e:
+                        emit_warning(f"Analiza tabeli opcji nie powiodła się: {e}")
+                if options_report is not None:
+                    print("\nNaprawa rozrostu tabeli opcji (--fix-autoload)...")
+                    fix_options_bloat(options_report)
+                else:
+                    emit_warning("Pominięto --fix-autoload, ponieważ analiza tabeli opcji nie powiodła się.")
+            journal_stage_complete(journal, "fix_autoload", fix_autoload_inputs)
 
-        print(f"Przenoszenie zawartości z backupu ({FULL_TEMP_DIR}) do {WP_ROOT_DIR}...")
-        items_to_exclude_from_move = [
-            os.path.basename(SQL_FILE_PATH),       
-            FINAL_ZIP_FILE,                        
-            os.path.basename(FULL_TEMP_WP_CONFIG_PATH), 
-            "wp-config.php" 
-        ]
-        moved_items_count = 0
-        for item_name in os.listdir(FULL_TEMP_DIR):
-            if item_name not in items_to_exclude_from_move:
-                source_item_path = os.path.join(FULL_TEMP_DIR, item_name)
-                destination_item_path = os.path.join(WP_ROOT_DIR, item_name)
-
-                if os.path.exists(destination_item_path):
-                    print(f"Ostrzeżenie: Element docelowy {destination_item_path} istnieje. Zostanie usunięty i nadpisany przez element z backupu.")
-                    if os.path.isdir(destination_item_path):
-                        shutil.rmtree(destination_item_path)
-                    else:
-                        os.remove(destination_item_path)
-                
-                shutil.move(source_item_path, destination_item_path)
-                moved_items_count +=1
-                print(f"Przeniesiono: {item_name} z {source_item_path} do {destination_item_path}")
+        file_rewrite_inputs = {'enabled': not args.no_file_rewrite, 'urls': urls_to_replace, 'new_url': NEW_URL}
+        if not journal_stage_done(journal, "file_rewrite", file_rewrite_inputs):
+            if args.no_file_rewrite:
+                print("\nPominięto podmianę domeny w plikach (--no-file-rewrite).")
+            else:
+                print(f"\nPodmiana '{SOURCE_DOMAIN}' i jego wariacji na '{NEW_URL}' w plikach (motywy, wtyczki, uploads, .htaccess)...")
+                rewrite_domain_in_files(
+                    [target_wp_content_full_path],
+                    [os.path.join(WP_ROOT_DIR, ".htaccess")],
+                    urls_to_replace, NEW_URL
+                )
+            journal_stage_complete(journal, "file_rewrite", file_rewrite_inputs)
+
+        # Po weryfikacji - zmienione obrazy nie zgadzałyby się z CRC32 z archiwum
+        optimize_images_inputs = {'enabled': args.optimize_images}
+        if not journal_stage_done(journal, "optimize_images", optimize_images_inputs):
+            if args.optimize_images:
+                print(f"\nOptymalizacja obrazów w {os.path.join(target_wp_content_full_path, 'uploads')}...")
+                legacy_cache_path = os.path.join(WP_ROOT_DIR, LEGACY_IMAGE_CACHE_FILE_NAME)
+                if os.path.exists(legacy_cache_path):
+                    print(f"Usuwanie publicznie dostępnego cache obrazów z poprzednich wersji: {legacy_cache_path}")
+                    os.remove(legacy_cache_path)
+                optimize_uploads_images(
+                    os.path.join(target_wp_content_full_path, "uploads"),
+                    FULL_IMAGE_CACHE_PATH,
+                    time_budget=args.image_time_budget
+                )
+            journal_stage_complete(journal, "optimize_images", optimize_images_inputs)
 
-        if moved_items_count == 0 :
-             print(f"Ostrzeżenie: Nie przeniesiono żadnych głównych elementów z katalogu backupu (np. wp-content). Sprawdź strukturę backupu w {FULL_TEMP_DIR}.")
-        print("Pliki/katalogi z backupu przeniesione.")
+        # --- POCZĄTEK SEKCJI USTAWIANIA UPRAWNIEŃ ZA POMOCĄ ZEWNĘTRZNEGO SKRYPTU ---
+        if not journal_stage_done(journal, "permissions"):
+            print(f"\nUstawianie uprawnień plików za pomocą zewnętrznego skryptu...")
+            if os.getcwd() != WP_ROOT_DIR:
+                print(f"Zmieniam katalog roboczy na {WP_ROOT_DIR} przed uruchomieniem skryptu uprawnień.")
+                os.chdir(WP_ROOT_DIR)
 
-        print(f"Przywracanie oryginalnego (ale zaktualizowanego o prefix) wp-config.php z {FULL_TEMP_WP_CONFIG_PATH} do {target_wp_config_path}...")
-        shutil.copy2(FULL_TEMP_WP_CONFIG_PATH, target_wp_config_path) 
-        print(f"Plik wp-config.php przywrócony do {target_wp_config_path}.")
+            print(f"-> Krok 1: Pobieranie skryptu uprawnień z {FIX_PERMISSIONS_SCRIPT_URL}...")
+            try:
+                response = requests.get(FIX_PERMISSIONS_SCRIPT_URL, timeout=30)
+                response.raise_for_status() # Sprawdź błędy HTTP
 
-        # --- POCZĄTEK SEKCJI USTAWIANIA UPRAWNIEŃ ZA POMOCĄ ZEWNĘTRZNEGO SKRYPTU ---
-        print(f"\nUstawianie uprawnień plików za pomocą zewnętrznego skryptu...")
-        if os.getcwd() != WP_ROOT_DIR:
-            print(f"Zmieniam katalog roboczy na {WP_ROOT_DIR} przed uruchomieniem skryptu uprawnień.")
-            os.chdir(WP_ROOT_DIR)
-        
-        print(f"-> Krok 1: Pobieranie skryptu uprawnień z {FIX_PERMISSIONS_SCRIPT_URL}...")
-        try:
-            response = requests.get(FIX_PERMISSIONS_SCRIPT_URL, timeout=30)
-            response.raise_for_status() # Sprawdź błędy HTTP
-            
-            # Zapisz skrypt lokalnie
-            with open(fix_permissions_script_path, 'w', encoding='utf-8') as f:
-                f.write(response.text)
-            print(f"  Skrypt zapisany jako: {fix_permissions_script_path}")
-
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"Błąd podczas pobierania skryptu uprawnień: {e}")
-        except IOError as e:
-             raise Exception(f"Błąd podczas zapisywania skryptu uprawnień do pliku '{fix_permissions_script_path}': {e}")
-
-        print(f"-> Krok 2: Nadawanie uprawnień do wykonania dla '{fix_permissions_script_path}'...")
-        try:
-            # Nadaj uprawnienia rwxr-xr-x (0o755)
-            os.chmod(fix_permissions_script_path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
-            print("  Uprawnienia do wykonania nadane.")
-        except OSError as e:
-             # Próbuj usunąć skrypt jeśli chmod zawiedzie
-             if os.path.exists(fix_permissions_script_path):
-                  try: os.remove(fix_permissions_script_path)
-                  except OSError: pass # Ignoruj błąd usuwania
-             raise Exception(f"Błąd podczas nadawania uprawnień do wykonania dla skryptu '{fix_permissions_script_path}': {e}")
-
-        print(f"-> Krok 3: Uruchamianie skryptu '{fix_permissions_script_path}'...")
-        # Uruchom skrypt za pomocą bash
-        # run_command oczekuje listy, więc przekazujemy listę z jednym elementem
-        script_run_result = run_command([fix_permissions_script_path], check=False) 
-        # run_command obsłuży logowanie stdout/stderr skryptu
-
-        if script_run_result is None or script_run_result.returncode != 0:
-             print(f"Ostrzeżenie: Wykonanie skryptu uprawnień '{fix_permissions_script_path}' zakończyło się błędem (kod {script_run_result.returncode if script_run_result else 'brak obiektu'}). Sprawdź logi powyżej.", file=sys.stderr)
-             # Nie przerywamy działania, ale logujemy ostrzeżenie
-        else:
-             print("  Skrypt uprawnień wykonany.")
+                # Zapisz skrypt lokalnie
+                with open(fix_permissions_script_path, 'w', encoding='utf-8') as f:
+                    f.write(response.text)
+                print(f"  Skrypt zapisany jako: {fix_permissions_script_path}")
 
-        print(f"-> Krok 4: Usuwanie tymczasowego skryptu '{fix_permissions_script_path}'...")
-        if os.path.exists(fix_permissions_script_path):
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"Błąd podczas pobierania skryptu uprawnień: {e}")
+            except IOError as e:
+                 raise Exception(f"Błąd podczas zapisywania skryptu uprawnień do pliku '{fix_permissions_script_path}': {e}")
+
+            print(f"-> Krok 2: Nadawanie uprawnień do wykonania dla '{fix_permissions_script_path}'...")
             try:
-                os.remove(fix_permissions_script_path)
-                print("  Tymczasowy skrypt usunięty.")
+                # Nadaj uprawnienia rwxr-xr-x (0o755)
+                os.chmod(fix_permissions_script_path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+                print("  Uprawnienia do wykonania nadane.")
             except OSError as e:
-                print(f"Ostrzeżenie: Nie udało się usunąć tymczasowego skryptu '{fix_permissions_script_path}': {e}", file=sys.stderr)
-        else:
-             print(f"  Informacja: Tymczasowy skrypt '{fix_permissions_script_path}' nie istniał, nie ma czego usuwać.")
+                 # Próbuj usunąć skrypt jeśli chmod zawiedzie
+                 if os.path.exists(fix_permissions_script_path):
+                      try: os.remove(fix_permissions_script_path)
+                      except OSError: pass # Ignoruj błąd usuwania
+                 raise Exception(f"Błąd podczas nadawania uprawnień do wykonania dla skryptu '{fix_permissions_script_path}': {e}")
+
+            print(f"-> Krok 3: Uruchamianie skryptu '{fix_permissions_script_path}'...")
+            # Uruchom skrypt za pomocą bash
+            # run_command oczekuje listy, więc przekazujemy listę z jednym elementem
+            script_run_result = run_command([fix_permissions_script_path], check=False)
+            # run_command obsłuży logowanie stdout/stderr skryptu
+
+            if script_run_result is None or script_run_result.returncode != 0:
+                 emit_warning(f"Wykonanie skryptu uprawnień '{fix_permissions_script_path}' zakończyło się błędem (kod {script_run_result.returncode if script_run_result else 'brak obiektu'}). Sprawdź logi powyżej.")
+                 # Nie przerywamy działania, ale logujemy ostrzeżenie
+            else:
+                 print("  Skrypt uprawnień wykonany.")
+
+            print(f"-> Krok 4: Usuwanie tymczasowego skryptu '{fix_permissions_script_path}'...")
+            if os.path.exists(fix_permissions_script_path):
+                try:
+                    os.remove(fix_permissions_script_path)
+                    print("  Tymczasowy skrypt usunięty.")
+                except OSError as e:
+                    emit_warning(f"Nie udało się usunąć tymczasowego skryptu '{fix_permissions_script_path}': {e}")
+            else:
+                 print(f"  Informacja: Tymczasowy skrypt '{fix_permissions_script_path}' nie istniał, nie ma czego usuwać.")
+            journal_stage_complete(journal, "permissions")
         # --- KONIEC SEKCJI USTAWIANIA UPRAWNIEŃ ZA POMOCĄ ZEWNĘTRZNEGO SKRYPTU ---
 
 
         print("\nWykonywanie końcowych operacji WP-CLI...")
-        if os.getcwd() != WP_ROOT_DIR: 
+        if os.getcwd() != WP_ROOT_DIR:
             os.chdir(WP_ROOT_DIR)
 
         print("Odświeżanie permanentnych linków...")
-        run_command([WP_CLI_BIN, "rewrite", "flush", "--hard"] + WP_CLI_FLAGS, check=False) 
+        run_command([WP_CLI_BIN, "rewrite", "flush", "--hard"] + WP_CLI_FLAGS, check=False)
 
         print(f"Aktualizacja opcji 'siteurl' i 'home' do {NEW_URL} (dodatkowe upewnienie)...")
         run_command([WP_CLI_BIN, "option", "update", "siteurl", NEW_URL] + WP_CLI_FLAGS, check=False)
@@ -568,26 +1750,33 @@ def main():
         print("Pominięto automatyczną aktualizację rdzenia, wtyczek i motywów.")
 
         print("Czyszczenie cache WP (jeśli wspierane)...")
-        run_command([WP_CLI_BIN, "cache", "flush"] + WP_CLI_FLAGS, check=False) 
+        run_command([WP_CLI_BIN, "cache", "flush"] + WP_CLI_FLAGS, check=False)
         print("Operacje WP-CLI zakończone.")
 
     except Exception as e:
         print(f"KRYTYCZNY BŁĄD SKRYPTU: {e}", file=sys.stderr)
+        # Etapy rozpoczęte, ale niezakończone - to one przerwały migrację
+        for failed_stage in list(_stage_started):
+            emit_stage(failed_stage, "error", message=str(e))
+        emit_event("error", message=str(e))
         import traceback
         traceback.print_exc(file=sys.stderr) 
         exit_code = 1
     finally:
+        # Przerwij analizę zrzutu, jeśli wciąż trwa (np. po nieudanym imporcie) - inaczej jej wątek blokowałby wyjście
+        analysis_stop.set()
         # Upewnij się, że tymczasowy skrypt jest usuwany nawet w przypadku błędu (jeśli istnieje)
         if os.path.exists(fix_permissions_script_path):
              print(f"Sprzątanie: Usuwanie tymczasowego skryptu '{fix_permissions_script_path}' (po potencjalnym błędzie)...")
              try:
                   os.remove(fix_permissions_script_path)
              except OSError as e:
-                  print(f"Ostrzeżenie: Nie udało się usunąć tymczasowego skryptu '{fix_permissions_script_path}' podczas sprzątania: {e}", file=sys.stderr)
+                  emit_warning(f"Nie udało się usunąć tymczasowego skryptu '{fix_permissions_script_path}' podczas sprzątania: {e}")
 
         if exit_code != 0:
             print(f"\nWAŻNE: Katalog tymczasowy {FULL_TEMP_DIR} NIE został usunięty z powodu błędu. Sprawdź jego zawartość.", file=sys.stderr)
             print(f"Możesz go usunąć ręcznie: rm -rf {FULL_TEMP_DIR}", file=sys.stderr)
+            print(f"Aby wznowić migrację od pierwszego nieukończonego etapu, uruchom skrypt ponownie z opcją --resume.", file=sys.stderr)
         else:
             print("\nSprzątanie plików tymczasowych...")
             cleanup_temp_dir()
@@ -607,7 +1796,8 @@ def main():
             print("Sprawdź logi powyżej pod kątem ewentualnych ostrzeżeń lub błędów.")
             print("---------------------------------------------------")
 
-
+        emit_event("run", status="success" if exit_code == 0 else "failed", exit_code=exit_code, new_url=NEW_URL)
+        stop_event_stream()
         sys.exit(exit_code)
 
 if __name__ == "__main__":